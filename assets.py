@@ -0,0 +1,86 @@
+'''
+URLs of the static assets (style.css, jQuery, images/) for the templates.
+
+tools/build_assets.py copies each asset to static/ under a name with its content hash in it and
+writes static/manifest.json. Those URLs change whenever the file does, so app.yaml can let browsers
+cache everything under /static for a year. Without a manifest (or on the dev server, where the files
+are being edited) the assets are served from their original, unversioned URLs, and so is any asset whose
+file changed since the manifest was built.
+'''
+import hashlib
+import json
+import logging
+import os
+import threading
+
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(APP_DIR, 'static')
+MANIFEST_PATH = os.path.join(STATIC_DIR, 'manifest.json')
+STATIC_URL_PREFIX = '/static/'
+
+
+def load_manifest():
+    '''
+    {'assets': {asset path: hashed path}, 'srcsets': {asset path: [(hashed path, descriptor)]},
+     'srcset_sources': {asset path: larger image its srcset was resized from},
+     'source_hashes': {path of every file the above were built from: its sha1}},
+    or None if the assets weren't built
+    '''
+    if os.environ.get('SERVER_SOFTWARE', '').startswith('Development') or not os.path.isfile(MANIFEST_PATH):
+        return None
+    try:
+        with open(MANIFEST_PATH) as f:
+            manifest = json.load(f)
+    except ValueError:
+        logging.exception('Ignoring the unreadable %s', MANIFEST_PATH)
+        return None
+    if 'source_hashes' not in manifest:
+        logging.warning('Ignoring %s, it was built by an older tools/build_assets.py', MANIFEST_PATH)
+        return None
+    return manifest
+
+
+def get_source_hash(path):
+    ''' sha1 of the file at `path` (relative to the app directory), or None if there's no such file '''
+    try:
+        with open(os.path.join(APP_DIR, path), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
+
+
+_manifest = load_manifest()
+# Asset path -> whether the file is still the one the manifest was built from. Filled in on first use,
+# so only the assets the pages actually use get hashed.
+_source_is_current = {}
+_source_lock = threading.Lock()
+
+
+def _is_current(path):
+    is_current = _source_is_current.get(path)
+    if is_current is None:
+        expected_hash = _manifest['source_hashes'].get(path)
+        is_current = expected_hash is not None and expected_hash == get_source_hash(path)
+        if not is_current:
+            logging.warning('Not using what was built from %s, it changed since tools/build_assets.py ran', path)
+        with _source_lock:
+            _source_is_current[path] = is_current
+    return is_current
+
+
+def asset_url(path):
+    ''' URL of the asset at `path` (relative to the app directory, i.e. "images/logo.jpg") '''
+    if _manifest is not None and path in _manifest['assets'] and _is_current(path):
+        return STATIC_URL_PREFIX + _manifest['assets'][path]
+    return '/' + path
+
+
+def asset_srcset(path):
+    ''' `srcset` attribute value with the resized versions of the image at `path`, or '' if there are none '''
+    if _manifest is None or path not in _manifest['srcsets']:
+        return ''
+    if not _is_current(path) or not _is_current(_manifest['srcset_sources'][path]):
+        return ''
+    return ', '.join('{}{} {}'.format(STATIC_URL_PREFIX, hashed_path, descriptor)
+                     for hashed_path, descriptor in _manifest['srcsets'][path])
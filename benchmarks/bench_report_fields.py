@@ -0,0 +1,272 @@
+'''
+Micro-benchmark of the per-report conversions: parsing the create report form into a Report, building
+the dict the templates display and merging one report into another. Compares the functions that
+report_fields.py generates from its schema against the hand-written versions they replaced (kept
+below as legacy_*), on the same synthetic reports, and prints microseconds per report.
+
+Usage (needs the App Engine Python SDK, i.e. the directory containing dev_appserver.py):
+    python benchmarks/bench_report_fields.py --sdk ~/google-cloud-sdk/platform/google_appengine --reports 2000
+'''
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DERIVED = {
+    'customers_this_year': 12000,
+    'dreams_this_year': 6000,
+    'dreamers_this_year': 4000,
+    'perfect_money_marathon': 12,
+    'daily_dream_goal': 40,
+    'achievement_rate': 95.5,
+}
+
+
+def setup_sdk_path(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+
+
+def legacy_get_integer_input(request, key, default=None):
+    val = request.get(key, default)
+    if val is not None and val != '':
+        val = val.replace('$', '')
+        int_val = int(val)
+    else:
+        int_val = None
+    return int_val
+
+
+def legacy_get_time_obj(end_time):
+    if end_time:
+        if ':' in end_time:
+            end_time_obj = datetime.datetime.strptime(end_time, '%H:%M').time()
+        else:
+            end_time_obj = datetime.datetime.strptime(end_time, '%H%M').time()
+    else:
+        end_time_obj = None
+    return end_time_obj
+
+
+def legacy_get_date_obj(date):
+    if date:
+        date_obj = datetime.datetime.strptime(date, '%Y-%m-%d')
+    else:
+        date_obj = None
+    return date_obj
+
+
+def legacy_populate_from_form(report, request):
+    date_string = request.get('date', '')
+    end_time_dishwasher = request.get('end_time_dishwasher', '')
+    end_time_host = request.get('end_time_host', '')
+    end_time_kitchen = request.get('end_time_kitchen', '')
+    report.date = legacy_get_date_obj(date_string)
+    report.end_time_dishwasher = legacy_get_time_obj(end_time_dishwasher)
+    report.end_time_host = legacy_get_time_obj(end_time_host)
+    report.end_time_kitchen = legacy_get_time_obj(end_time_kitchen)
+    report.lunch_customers_today = legacy_get_integer_input(request, 'lunch_customers_today')
+    report.customers_today = legacy_get_integer_input(request, 'customers_today')
+    report.lunch_dreams = legacy_get_integer_input(request, 'lunch_dreams')
+    report.dreams = legacy_get_integer_input(request, 'dreams')
+    report.lunch_dreamers = legacy_get_integer_input(request, 'lunch_dreamers')
+    report.dreamers = legacy_get_integer_input(request, 'dreamers')
+    report.working_dishwasher = request.get('working_dishwasher', '')
+    report.working_host = request.get('working_host', '')
+    report.working_kitchen2 = request.get('working_kitchen2', '')
+    report.working_kitchen = request.get('working_kitchen', '')
+    report.supporting_members = request.get('supporting_members', '')
+    report.visiting_members = request.get('visiting_members', '')
+    report.total_bowls = legacy_get_integer_input(request, 'total_bowls')
+    report.total_cups = legacy_get_integer_input(request, 'total_cups')
+    report.chopsticks_missing = legacy_get_integer_input(request, 'chopsticks_missing')
+    report.money_off_by = legacy_get_integer_input(request, 'money_off_by')
+    report.positive_cycle = legacy_get_integer_input(request, 'positive_cycle')
+    report.misc_notes = request.get('misc_notes', '')
+
+
+def legacy_to_display_dict(current_report, derived):
+    end_time = current_report.get_end_time()
+    customers_today = current_report.get_customers_today()
+    dreams = current_report.get_dreams()
+    dreamers = current_report.get_dreamers()
+    readable_date_string = current_report.readable_date_string
+    return {
+        'month_goal': current_report.month_goal if current_report.month_goal is not None else '',
+        'year_goal': current_report.year_goal if current_report.year_goal is not None else '',
+        'datetime_obj': current_report.date,
+        'date': current_report.date.strftime('%Y-%m-%d') if current_report.date is not None else '',
+        'date_string': current_report.date.strftime('%Y-%m-%d') if current_report.date is not None else '',
+        'readable_date_string': readable_date_string if readable_date_string is not None else '',
+        'lunch_customers_today': current_report.lunch_customers_today if current_report.lunch_customers_today is not None else '',
+        'dinner_customers_today': current_report.dinner_customers_today if current_report.dinner_customers_today is not None else '',
+        'lunch_dreams': current_report.lunch_dreams if current_report.lunch_dreams is not None else '',
+        'dinner_dreams': current_report.dinner_dreams if current_report.dinner_dreams is not None else '',
+        'lunch_dreamers': current_report.lunch_dreamers if current_report.lunch_dreamers is not None else '',
+        'dinner_dreamers': current_report.dinner_dreamers if current_report.dinner_dreamers is not None else '',
+        'working_dishwasher': current_report.working_dishwasher if current_report.working_dishwasher is not None else '',
+        'working_host': current_report.working_host if current_report.working_host is not None else '',
+        'working_kitchen2': current_report.working_kitchen2 if current_report.working_kitchen2 is not None else '',
+        'working_kitchen': current_report.working_kitchen if current_report.working_kitchen is not None else '',
+        'working_members': current_report.working_members if current_report.working_members is not None else '',
+        'supporting_members': current_report.supporting_members if current_report.supporting_members is not None else '',
+        'visiting_members': current_report.visiting_members if current_report.visiting_members is not None else '',
+        'end_time': end_time.strftime('%H:%M') if end_time is not None else '',
+        'end_time_dishwasher': current_report.end_time_dishwasher.strftime('%H:%M') if current_report.end_time_dishwasher is not None else '',
+        'end_time_host': current_report.end_time_host.strftime('%H:%M') if current_report.end_time_host is not None else '',
+        'end_time_kitchen': current_report.end_time_kitchen.strftime('%H:%M') if current_report.end_time_kitchen is not None else '',
+        'positive_cycle': current_report.positive_cycle if current_report.positive_cycle is not None else '',
+        'total_bowls': current_report.total_bowls if current_report.total_bowls is not None else '',
+        'total_cups': current_report.total_cups if current_report.total_cups is not None else '',
+        'chopsticks_missing': current_report.chopsticks_missing if current_report.chopsticks_missing is not None else '',
+        'money_off_by': current_report.money_off_by if current_report.money_off_by is not None else '',
+        'misc_notes': current_report.misc_notes if current_report.misc_notes is not None else '',
+        'customers_today': customers_today if customers_today is not None else '',
+        'dreams': dreams if dreams is not None else '',
+        'dreamers': dreamers if dreamers is not None else '',
+        'daily_dream_goal': derived['daily_dream_goal'] or '',
+        'yearly_dream_goal': current_report.yearly_dream_goal or '',
+        'customers_this_year': derived['customers_this_year'],
+        'dreams_this_year': derived['dreams_this_year'],
+        'dreamers_this_year': derived['dreamers_this_year'],
+        'perfect_money_marathon': derived['perfect_money_marathon'],
+        'achievement_rate': '{:.2f}%'.format(derived['achievement_rate']) if derived['achievement_rate'] is not None else '',
+    }
+
+
+def legacy_merge(self, old_report):
+    if old_report.year_goal: self.year_goal = old_report.year_goal
+    if old_report.month_goal: self.month_goal = old_report.month_goal
+    if old_report.working_dishwasher: self.working_dishwasher = old_report.working_dishwasher
+    if old_report.working_host: self.working_host = old_report.working_host
+    if old_report.working_kitchen2: self.working_kitchen2 = old_report.working_kitchen2
+    if old_report.working_kitchen: self.working_kitchen = old_report.working_kitchen
+    if old_report.working_members: self.working_members = old_report.working_members
+    if old_report.supporting_members: self.supporting_members = old_report.supporting_members
+    if old_report.visiting_members: self.visiting_members = old_report.visiting_members
+    if old_report.misc_notes: self.misc_notes = old_report.misc_notes
+    if old_report.yearly_dream_goal is not None: self.yearly_dream_goal = old_report.yearly_dream_goal
+    if old_report.daily_dream_goal is not None: self.daily_dream_goal = old_report.daily_dream_goal
+    if old_report.date is not None: self.date = old_report.date
+    if old_report.customers_today is not None: self.customers_today = old_report.customers_today
+    if old_report.lunch_customers_today is not None: self.lunch_customers_today = old_report.lunch_customers_today
+    if old_report.dinner_customers_today is not None: self.dinner_customers_today = old_report.dinner_customers_today
+    if old_report.dreams is not None: self.dreams = old_report.dreams
+    if old_report.lunch_dreams is not None: self.lunch_dreams = old_report.lunch_dreams
+    if old_report.dinner_dreams is not None: self.dinner_dreams = old_report.dinner_dreams
+    if old_report.dreamers is not None: self.dreamers = old_report.dreamers
+    if old_report.lunch_dreamers is not None: self.lunch_dreamers = old_report.lunch_dreamers
+    if old_report.dinner_dreamers is not None: self.dinner_dreamers = old_report.dinner_dreamers
+    if old_report.end_time_dishwasher is not None: self.end_time_dishwasher = old_report.end_time_dishwasher
+    if old_report.end_time_host is not None: self.end_time_host = old_report.end_time_host
+    if old_report.end_time_kitchen is not None: self.end_time_kitchen = old_report.end_time_kitchen
+    if old_report.end_time is not None: self.end_time = old_report.end_time
+    if old_report.total_bowls is not None: self.total_bowls = old_report.total_bowls
+    if old_report.total_cups is not None: self.total_cups = old_report.total_cups
+    if old_report.chopsticks_missing is not None: self.chopsticks_missing = old_report.chopsticks_missing
+    if old_report.money_off_by is not None: self.money_off_by = old_report.money_off_by
+    if old_report.positive_cycle is not None: self.positive_cycle = old_report.positive_cycle
+
+
+def make_requests(num_reports, seed=0):
+    ''' Create report form submissions, as webapp2 requests, one per day from 2018-01-02 on '''
+    import webapp2
+    rng = random.Random(seed)
+    requests = []
+    for i in range(num_reports):
+        date = datetime.date(2018, 1, 2) + datetime.timedelta(days=i)
+        lunch_customers = rng.randint(30, 90)
+        lunch_dreams = rng.randint(10, 40)
+        lunch_dreamers = rng.randint(5, lunch_dreams)
+        form = {
+            'date': date.strftime('%Y-%m-%d'),
+            'lunch_customers_today': str(lunch_customers),
+            'customers_today': str(lunch_customers + rng.randint(50, 120)),
+            'lunch_dreams': str(lunch_dreams),
+            'dreams': str(lunch_dreams + rng.randint(20, 60)),
+            'lunch_dreamers': str(lunch_dreamers),
+            'dreamers': str(lunch_dreamers + rng.randint(10, 30)),
+            'working_dishwasher': 'Dish', 'working_host': 'Host', 'working_kitchen2': 'Kitchen 2', 'working_kitchen': 'Kitchen',
+            'supporting_members': '', 'visiting_members': '',
+            'end_time_dishwasher': '23:{:02d}'.format(rng.randint(0, 59)),
+            'end_time_host': '23{:02d}'.format(rng.randint(0, 59)),
+            'end_time_kitchen': '22:{:02d}'.format(rng.randint(0, 59)),
+            'total_bowls': str(rng.randint(100, 300)), 'total_cups': str(rng.randint(50, 200)),
+            'chopsticks_missing': str(rng.randint(0, 3)), 'money_off_by': '$0', 'positive_cycle': str(rng.randint(0, 100)),
+            'misc_notes': 'Synthetic report',
+        }
+        requests.append(webapp2.Request.blank('/createreport', POST=form))
+    return requests
+
+
+def time_per_report(function, arguments):
+    ''' Best of 3 passes over `arguments`, in microseconds per call '''
+    best = None
+    for _ in range(3):
+        start = time.time()
+        for args in arguments:
+            function(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(arguments) * 1e6
+
+
+def run(num_reports, seed=0):
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    try:
+        import main
+        import report_fields
+        from report import Report
+        requests = make_requests(num_reports, seed)
+        reports = []
+        for request in requests:
+            report = Report()
+            report_fields.populate_from_form(report, request)
+            main._populate_dinner_totals(report)
+            report.yearly_dream_goal = 12000
+            reports.append(report)
+        targets = [Report() for _ in reports]
+
+        def new_to_display_dict(report, derived):
+            return main.create_report_dict_from_report_obj(report, derived=derived)
+
+        cases = [
+            ('parse form', [(Report(), request) for request in requests],
+             legacy_populate_from_form, report_fields.populate_from_form),
+            ('display dict', [(report, DERIVED) for report in reports],
+             legacy_to_display_dict, new_to_display_dict),
+            ('merge', list(zip(targets, reports)),
+             legacy_merge, report_fields.merge_fields),
+        ]
+        print('{:<14} {:>12} {:>12} {:>9}'.format('conversion', 'legacy us', 'schema us', 'speedup'))
+        for name, arguments, legacy, generated in cases:
+            legacy_us = time_per_report(legacy, arguments)
+            generated_us = time_per_report(generated, arguments)
+            print('{:<14} {:>12.1f} {:>12.1f} {:>8.2f}x'.format(name, legacy_us, generated_us, legacy_us / generated_us))
+    finally:
+        bed.deactivate()
+
+
+def run_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'), help='Path to the App Engine Python SDK')
+    parser.add_argument('--reports', type=int, default=2000, help='Number of synthetic reports to convert')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic reports')
+    args = parser.parse_args()
+    setup_sdk_path(args.sdk)
+    run(args.reports, args.seed)
+
+
+if __name__ == '__main__':
+    run_from_command_line()
@@ -0,0 +1,178 @@
+'''
+Benchmarks the main pages against N years of synthetic reports, in-process on the local datastore stub.
+
+For each history size it seeds a fresh stub datastore, then requests every route once with all the
+caches flushed (cold) and then again (warm), and prints the wall time, datastore RPCs and entities
+fetched for each request.
+
+Usage (needs the App Engine Python SDK, i.e. the directory containing dev_appserver.py):
+    python benchmarks/bench_routes.py --sdk ~/google-cloud-sdk/platform/google_appengine --years 1 5 20
+'''
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_sdk_path(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+
+
+def make_synthetic_report(date, yearly_dream_goal, rng):
+    ''' A plausible finalized report: open Tuesday-Saturday, busier on the weekend '''
+    from report import Report
+    busy = 1.3 if date.weekday() in (4, 5) else 1.0
+    lunch_customers = int(rng.gauss(60, 12) * busy)
+    customers = lunch_customers + int(rng.gauss(90, 18) * busy)
+    lunch_dreamers = int(lunch_customers * rng.uniform(0.2, 0.5))
+    dreamers = lunch_dreamers + int((customers - lunch_customers) * rng.uniform(0.2, 0.5))
+    lunch_dreams = lunch_dreamers + rng.randint(0, 10)
+    dreams = lunch_dreams + (dreamers - lunch_dreamers) + rng.randint(0, 15)
+    end_hour = rng.choice([22, 23, 23, 0])
+    report = Report(
+        id=date.strftime('%Y-%m-%d'),
+        date=datetime.datetime(date.year, date.month, date.day),
+        yearly_dream_goal=yearly_dream_goal,
+        year_goal='Synthetic year goal',
+        month_goal='Synthetic month goal',
+        lunch_customers_today=lunch_customers,
+        customers_today=customers,
+        dinner_customers_today=customers - lunch_customers,
+        lunch_dreamers=lunch_dreamers,
+        dreamers=dreamers,
+        dinner_dreamers=dreamers - lunch_dreamers,
+        lunch_dreams=lunch_dreams,
+        dreams=dreams,
+        dinner_dreams=dreams - lunch_dreams,
+        working_dishwasher='Dish', working_host='Host', working_kitchen='Kitchen', working_kitchen2='Kitchen 2',
+        supporting_members='', visiting_members='',
+        end_time_dishwasher=datetime.time(end_hour, rng.randint(0, 59)),
+        end_time_host=datetime.time(end_hour, rng.randint(0, 59)),
+        end_time_kitchen=datetime.time(end_hour, rng.randint(0, 59)),
+        total_bowls=rng.randint(100, 300), total_cups=rng.randint(50, 200), chopsticks_missing=rng.randint(0, 3),
+        money_off_by=0 if rng.random() < 0.9 else rng.randint(1, 20),
+        positive_cycle=rng.randint(0, 100),
+        misc_notes='Synthetic report',
+    )
+    return report
+
+
+def seed_reports(num_years, seed=0):
+    '''
+    Fills the datastore with `num_years` years of reports ending yesterday, plus the goals.
+    Returns the date of the most recent report.
+    '''
+    from google.appengine.ext import ndb
+    import main
+    from report import YearTotals, update_year_derived_data
+
+    rng = random.Random(seed)
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    first_day = datetime.date(yesterday.year - num_years + 1, 1, 1)
+    reports = []
+    day = first_day
+    last_date = None
+    while day <= yesterday:
+        if day.weekday() in (1, 2, 3, 4, 5):
+            reports.append(make_synthetic_report(day, 12000, rng))
+            last_date = day
+        day += datetime.timedelta(days=1)
+    for i in range(0, len(reports), 500):
+        ndb.put_multi(reports[i:i + 500])
+    main.Goals(id='goals', yearly_dream_goal=12000, year_goal='Synthetic year goal', month_goal='Synthetic month goal').put()
+    for year in range(first_day.year, yesterday.year + 1):
+        YearTotals.rebuild(year)
+        # Stores the yearly numbers and rollups, so the routes are measured in their steady state
+        if not update_year_derived_data(year):
+            raise RuntimeError('Could not bring the derived data of {} up to date'.format(year))
+    return last_date
+
+
+def flush_caches():
+    ''' Empties memcache, the ndb context cache and the per-instance caches '''
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    import main
+    import report
+    memcache.flush_all()
+    ndb.get_context().clear_cache()
+    report._year_indexes.clear()
+    main._cached_goals.clear()
+
+
+def get_routes(last_date):
+    today = datetime.date.today()
+    return [
+        ('/', '/'),
+        ('/stats', '/stats'),
+        ('/report/<date>', '/report/' + last_date.strftime('%Y-%m-%d')),
+        ('/createreport', '/createreport'),
+        ('/dreamcalculator', '/dreamcalculator?month={}&lunch_customers_today=60&lunch_dreams=30&lunch_dreamers=20'
+                             '&dinner_customers_today=90&dinner_dreams=45&dinner_dreamers=30'.format(today.month)),
+        ('/api/preview', '/api/preview?date={}&lunch_customers_today=60&customers_today=150&lunch_dreams=30'
+                         '&dreams=75&lunch_dreamers=20&dreamers=50'.format(last_date.strftime('%Y-%m-%d'))),
+    ]
+
+
+def time_request(app, path):
+    ''' Requests `path` through the perf middleware and returns (wall ms, datastore RPCs, entities fetched) '''
+    from google.appengine.ext import ndb
+    import webapp2
+    ndb.get_context().clear_cache()
+    request = webapp2.Request.blank(path)
+    start = time.time()
+    response = request.get_response(app)
+    elapsed_ms = (time.time() - start) * 1000
+    if response.status_int != 200:
+        raise RuntimeError('{} returned {}'.format(path, response.status))
+    stats = request.environ['perf.stats']
+    return (elapsed_ms, stats.gets + stats.queries, stats.entities)
+
+
+def run(years_list, seed=0):
+    from google.appengine.ext import testbed
+    print('{:>5}  {:<16} {:>10} {:>6} {:>9}   {:>10} {:>6} {:>9}'.format(
+        'years', 'route', 'cold ms', 'rpcs', 'entities', 'warm ms', 'rpcs', 'entities'))
+    for num_years in years_list:
+        bed = testbed.Testbed()
+        bed.activate()
+        bed.init_datastore_v3_stub()
+        bed.init_memcache_stub()
+        bed.init_user_stub()
+        bed.setup_env(USER_EMAIL='bench@example.com', USER_IS_ADMIN='1', overwrite=True)
+        try:
+            import main
+            import perf
+            # The testbed swapped in a new apiproxy, which doesn't have the perf hooks
+            perf.install_datastore_hooks()
+            last_date = seed_reports(num_years, seed)
+            for name, path in get_routes(last_date):
+                flush_caches()
+                cold = time_request(main.app, path)
+                warm = time_request(main.app, path)
+                print('{:>5}  {:<16} {:>10.1f} {:>6} {:>9}   {:>10.1f} {:>6} {:>9}'.format(
+                    num_years, name, cold[0], cold[1], cold[2], warm[0], warm[1], warm[2]))
+        finally:
+            bed.deactivate()
+
+
+def run_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'), help='Path to the App Engine Python SDK')
+    parser.add_argument('--years', type=int, nargs='+', default=[1, 5, 20], help='History sizes to benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the synthetic reports')
+    args = parser.parse_args()
+    setup_sdk_path(args.sdk)
+    run(args.years, args.seed)
+
+
+if __name__ == '__main__':
+    run_from_command_line()
@@ -0,0 +1,91 @@
+'''
+Measures what a new instance pays before it can answer: importing main, then the first request to
+/ and the first request to /stats (which imports NumPy), each in a fresh Python process.
+
+Run it with and without compiled_templates/ (see tools/compile_templates.py) to compare the two.
+
+Usage (needs the App Engine Python SDK, i.e. the directory containing dev_appserver.py):
+    python benchmarks/bench_startup.py --sdk ~/google-cloud-sdk/platform/google_appengine --trials 10
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ['import main', 'first /', 'first /stats']
+
+
+def setup_sdk_path(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+
+
+def time_request(app, path):
+    import webapp2
+    start = time.time()
+    response = webapp2.Request.blank(path).get_response(app)
+    if response.status_int != 200:
+        raise RuntimeError('{} returned {}'.format(path, response.status))
+    return (time.time() - start) * 1000
+
+
+def run_child():
+    ''' One cold start, printed as JSON for the parent process '''
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    # Not 'Development', which would make main.py skip the compiled templates
+    bed.setup_env(USER_EMAIL='bench@example.com', USER_IS_ADMIN='1', SERVER_SOFTWARE='Google App Engine/bench_startup',
+                  overwrite=True)
+    try:
+        timings = {}
+        start = time.time()
+        import main
+        timings['import main'] = (time.time() - start) * 1000
+        timings['first /'] = time_request(main.app, '/')
+        timings['first /stats'] = time_request(main.app, '/stats')
+        timings['compiled templates'] = not isinstance(main.JINJA_ENVIRONMENT.loader, main.jinja2.FileSystemLoader)
+        print(json.dumps(timings))
+    finally:
+        bed.deactivate()
+
+
+def run(sdk_path, trials):
+    command = [sys.executable, os.path.abspath(__file__), '--child']
+    if sdk_path:
+        command += ['--sdk', sdk_path]
+    results = []
+    for _ in range(trials):
+        output = subprocess.check_output(command)
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    print('compiled templates: {}'.format('yes' if results[0]['compiled templates'] else 'no'))
+    print('{:<14} {:>10} {:>10} {:>10}'.format('stage', 'min ms', 'median ms', 'max ms'))
+    for stage in STAGES:
+        values = sorted(result[stage] for result in results)
+        print('{:<14} {:>10.1f} {:>10.1f} {:>10.1f}'.format(stage, values[0], values[len(values) // 2], values[-1]))
+
+
+def run_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'), help='Path to the App Engine Python SDK')
+    parser.add_argument('--trials', type=int, default=5, help='Number of fresh processes to time')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    setup_sdk_path(args.sdk)
+    if args.child:
+        run_child()
+    else:
+        run(args.sdk, args.trials)
+
+
+if __name__ == '__main__':
+    run_from_command_line()
@@ -0,0 +1,182 @@
+'''
+Bulk export and import of reports, i.e. for backups or moving the data to another app.
+
+Exports are generators that page through the reports with a datastore cursor, so memory use doesn't
+grow with the number of reports. Imports read the upload row by row, validate each row exactly like the
+create report form does, and save in fixed-size batches through `report.save_reports`, which keeps the
+YearTotals in step with the reports it writes and replaces.
+'''
+import csv
+import io
+import json
+
+from report import Report, save_reports, update_year_derived_data_or_retry
+
+
+EXPORT_BATCH_SIZE = 200
+IMPORT_BATCH_SIZE = 200
+
+# The create report form fields, then the goal snapshot and the fields only older reports have.
+# Values are exported the way they're typed into the form, so an export can be imported as is.
+EXPORT_FIELDS = [
+    'date',
+    'lunch_customers_today',
+    'customers_today',
+    'lunch_dreams',
+    'dreams',
+    'lunch_dreamers',
+    'dreamers',
+    'working_dishwasher',
+    'working_host',
+    'working_kitchen2',
+    'working_kitchen',
+    'supporting_members',
+    'visiting_members',
+    'end_time_dishwasher',
+    'end_time_host',
+    'end_time_kitchen',
+    'total_bowls',
+    'total_cups',
+    'chopsticks_missing',
+    'money_off_by',
+    'positive_cycle',
+    'misc_notes',
+    'yearly_dream_goal',
+    'year_goal',
+    'month_goal',
+    'working_members',
+    'end_time',
+]
+
+
+def iter_reports(batch_size=EXPORT_BATCH_SIZE):
+    ''' Every report, oldest first, fetched `batch_size` at a time and kept out of the ndb caches '''
+    cursor = None
+    while True:
+        reports, cursor, more = Report.query().order(Report.date).fetch_page(
+            batch_size, start_cursor=cursor, use_cache=False, use_memcache=False)
+        for report in reports:
+            yield report
+        if not more or cursor is None:
+            break
+
+
+def report_to_row(report):
+    ''' The report as a dict of EXPORT_FIELDS -> form-style strings ('' for missing values) '''
+    row = {}
+    for field in EXPORT_FIELDS:
+        value = getattr(report, field)
+        if value is None:
+            row[field] = u''
+        elif field == 'date':
+            row[field] = unicode(value.strftime('%Y-%m-%d'))
+        elif field.startswith('end_time'):
+            row[field] = unicode(value.strftime('%H:%M'))
+        else:
+            row[field] = unicode(value)
+    return row
+
+
+def export_csv(reports):
+    ''' Yields the CSV export of `reports` a line at a time '''
+    buffer = io.BytesIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        data = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return data
+
+    writer.writerow(EXPORT_FIELDS)
+    yield flush()
+    for report in reports:
+        row = report_to_row(report)
+        writer.writerow([row[field].encode('utf-8') for field in EXPORT_FIELDS])
+        yield flush()
+
+
+def export_jsonl(reports):
+    ''' Yields the JSON lines export of `reports`, one report per line '''
+    for report in reports:
+        yield json.dumps(report_to_row(report), sort_keys=True) + '\n'
+
+
+def iter_csv_rows(file_obj):
+    ''' The rows of a CSV upload, still undecoded, see `decode_csv_row` '''
+    return csv.DictReader(file_obj)
+
+
+def decode_csv_row(row):
+    ''' Raises ValueError if the row isn't UTF-8 '''
+    return dict((key, value.decode('utf-8')) for key, value in row.items() if key is not None and value is not None)
+
+
+def iter_jsonl_rows(file_obj):
+    ''' The non-empty lines of a JSON lines upload, still unparsed, see `decode_jsonl_row` '''
+    for line in file_obj:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def decode_jsonl_row(line):
+    ''' Raises ValueError if the line isn't a JSON object '''
+    row = json.loads(line)
+    if not isinstance(row, dict):
+        raise ValueError('not a JSON object')
+    # Same strings the form (and the CSV export) would give us
+    return dict((key, unicode(value) if value is not None else u'') for key, value in row.items())
+
+
+def get_report_from_row(row, current_goals):
+    '''
+    Builds a Report from an imported row, with the same parsing and validation as the create report
+    form. The row's goal snapshot and legacy fields are kept if it has them.
+    '''
+    from main import get_report_from_request, get_integer_input, get_time_obj
+    report = get_report_from_request(row, current_goals=current_goals)
+    if report.date is None:
+        raise ValueError('missing date')
+    if row.get('yearly_dream_goal'):
+        report.yearly_dream_goal = get_integer_input(row, 'yearly_dream_goal')
+    if row.get('year_goal'):
+        report.year_goal = row['year_goal']
+    if row.get('month_goal'):
+        report.month_goal = row['month_goal']
+    if row.get('working_members'):
+        report.working_members = row['working_members']
+    if row.get('end_time'):
+        report.end_time = get_time_obj(row['end_time'])
+    return report
+
+
+def import_rows(rows, decode_row, current_goals, batch_size=IMPORT_BATCH_SIZE):
+    '''
+    Saves the reports in `rows` (overwriting existing reports for the same dates) in batches of
+    `batch_size`, updating the YearTotals with the reports each batch writes and replaces, then brings
+    the month rollups and stored yearly numbers of every year that was touched up to date.
+    `decode_row` turns a row into a dict of strings (`decode_csv_row` or `decode_jsonl_row`).
+    Returns (number of reports saved, list of error strings for rows that were skipped).
+    '''
+    num_saved = 0
+    errors = []
+    years = set()
+    batch = []
+    for line_number, row in enumerate(rows, 1):
+        try:
+            report = get_report_from_row(decode_row(row), current_goals)
+        except (ValueError, TypeError) as e:
+            errors.append('Row {}: {}'.format(line_number, e))
+            continue
+        batch.append(report)
+        if len(batch) >= batch_size:
+            years.update(save_reports(batch))
+            num_saved += len(batch)
+            batch = []
+    if batch:
+        years.update(save_reports(batch))
+        num_saved += len(batch)
+    for year in sorted(years):
+        update_year_derived_data_or_retry(year)
+    return (num_saved, errors)
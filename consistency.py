@@ -0,0 +1,286 @@
+'''
+Consistency checker for everything derived from the reports: the YearTotals, the month rollups, the
+yearly numbers stored on each Report and this instance's cached YearIndexes.
+
+`check` streams every report by cursor, recomputes all of those from scratch a year at a time with
+the same code the app uses (YearIndex / ReportContext, YearTotals.add, rollups.build_rollups) and
+reports whatever differs from what's stored. With `repair=True` each year is read again with gets
+instead of the (eventually consistent) query before it's checked, so nothing is repaired from a view
+that's missing or behind on a recent write. A year that needs repairing gets its recomputed totals and
+a new YearTotals version, unless it was written to in the meantime, and then the app's own
+`update_year_derived_data` rewrites the reports' yearly numbers and the rollups. The new version also
+keeps the cached pages, ETags and instance caches of that year from serving what was there before.
+
+Runs from /admin/consistency (the repair as a task, see `repair_task`), or from the command line with
+tools/check_consistency.py.
+'''
+import collections
+import datetime
+import logging
+import time
+
+from google.appengine.api import namespace_manager
+from google.appengine.ext import ndb
+
+import bulk
+import page_cache
+import report
+import rollups
+from report import Report, ReportContext, ReportRow, YearTotals, update_year_derived_data_or_retry
+
+
+# How many discrepancies the summary spells out, the rest are only counted
+MAX_EXAMPLES = 50
+YEAR_TOTALS_FIELDS = ['dreams', 'dreamers', 'customers', 'report_count', 'last_finalized_date']
+
+
+class CheckSummary(object):
+    def __init__(self, repair):
+        self.repair = repair
+        self.start = time.time()
+        self.elapsed = None
+        self.reports_checked = 0
+        self.years_checked = 0
+        self.discrepancies = collections.Counter()
+        self.repaired = collections.Counter()
+        self.examples = []
+
+    def add_discrepancy(self, kind, message):
+        self.discrepancies[kind] += 1
+        if len(self.examples) < MAX_EXAMPLES:
+            self.examples.append('{}: {}'.format(kind, message))
+
+    def finish(self):
+        self.elapsed = time.time() - self.start
+        return self
+
+    def as_text(self):
+        lines = ['Checked {} reports in {} years in {:.1f}s ({:.0f} reports/s)'.format(
+            self.reports_checked, self.years_checked, self.elapsed, self.reports_checked / max(self.elapsed, 1e-6))]
+        if not self.discrepancies:
+            lines.append('No discrepancies')
+        for kind in sorted(self.discrepancies):
+            line = '{}: {} discrepancies'.format(kind, self.discrepancies[kind])
+            if self.repair:
+                line += ', {} repaired'.format(self.repaired[kind])
+            lines.append(line)
+        if self.examples:
+            lines.append('')
+            lines.extend(self.examples)
+            if sum(self.discrepancies.values()) > len(self.examples):
+                lines.append('...')
+        return '\n'.join(lines) + '\n'
+
+
+def _differs(stored, expected):
+    if isinstance(stored, float) and isinstance(expected, float):
+        return abs(stored - expected) > 1e-6
+    return stored != expected
+
+
+def _dict_differs(stored, expected):
+    return any(_differs(stored[key], expected[key]) for key in expected)
+
+
+def _check_report_fields(entries, context, summary):
+    ''' Returns (key, kind of discrepancy) of the reports whose stored yearly numbers are missing or wrong '''
+    stale_reports = []
+    for key, row, stored in entries:
+        expected = context.get_derived_fields(row)
+        if stored is None:
+            summary.add_discrepancy('report fields missing', key.id())
+            stale_reports.append((key, 'report fields missing'))
+        elif _dict_differs(stored, expected):
+            summary.add_discrepancy('report fields', '{}: stored {}, expected {}'.format(key.id(), stored, expected))
+            stale_reports.append((key, 'report fields'))
+    return stale_reports
+
+
+def _check_year_totals(year, rows, summary):
+    ''' Returns the recomputed YearTotals if the stored ones are missing or wrong, otherwise None '''
+    expected = YearTotals(key=YearTotals.key_for_year(year))
+    for row in rows:
+        expected.add(row)
+    totals = expected.key.get()
+    if totals is None:
+        if expected.report_count == 0:
+            return None
+        summary.add_discrepancy('year totals', '{}: missing'.format(year))
+        return expected
+    stored_values = dict((field, getattr(totals, field)) for field in YEAR_TOTALS_FIELDS)
+    expected_values = dict((field, getattr(expected, field)) for field in YEAR_TOTALS_FIELDS)
+    if _dict_differs(stored_values, expected_values):
+        summary.add_discrepancy('year totals', '{}: stored {}, expected {}'.format(year, stored_values, expected_values))
+        return expected
+    return None
+
+
+def _check_rollups(year, context, summary):
+    ''' Returns the recomputed rollups that are missing or wrong '''
+    expected_rollups = rollups.build_rollups(year, context.index)
+    stored_rollups = ndb.get_multi([rollup.key for rollup in expected_rollups])
+    stale_rollups = []
+    for stored, expected in zip(stored_rollups, expected_rollups):
+        if stored is None:
+            # Rollups are built on demand, so only a missing month that has reports is worth mentioning
+            if expected.denom > 0:
+                summary.add_discrepancy('month rollups', '{}: missing'.format(expected.key.id()))
+                stale_rollups.append(expected)
+        elif _dict_differs(stored.to_dict(), expected.to_dict()):
+            summary.add_discrepancy('month rollups', '{}: stored {}, expected {}'.format(
+                expected.key.id(), stored.to_dict(), expected.to_dict()))
+            stale_rollups.append(expected)
+    return stale_rollups
+
+
+def _check_cached_index(year, context, summary):
+    ''' Returns True if this instance's cached YearIndex for `year` disagrees with the recomputed one '''
+    cached = report._year_indexes.get(report.get_year_index_cache_key(year))
+    if cached is None:
+        return False
+    expected = context.index
+    if (cached.dates != expected.dates or cached.dreams != expected.dreams or cached.dreamers != expected.dreamers or
+            cached.customers != expected.customers or cached.last_money_miss != expected.last_money_miss or
+            cached.daily_dream_goals != expected.daily_dream_goals):
+        summary.add_discrepancy('cached year index', '{}: version {}'.format(year, cached.version))
+        return True
+    return False
+
+
+def _check_derived_version(year, summary):
+    '''
+    Returns True if the stored yearly numbers and rollups of `year` haven't caught up with its YearTotals.
+    That's normal right after a write, but not for long unless the task retrying the update is stuck.
+    '''
+    totals = YearTotals.key_for_year(year).get()
+    if totals is None or totals.derived_is_current:
+        return False
+    summary.add_discrepancy('derived data behind', '{}: version {}, derived version {}'.format(
+        year, totals.version, totals.derived_version))
+    return True
+
+
+def _get_totals_version(year):
+    totals = YearTotals.key_for_year(year).get(use_cache=False, use_memcache=False)
+    return totals.version if totals is not None else None
+
+
+def _get_year_entries(year, entries):
+    '''
+    `entries` read again with gets, which unlike the query see every write: the reports at their keys
+    and at every date of `year`, as (key, ReportRow, stored yearly numbers)
+    '''
+    keys = set(key for key, _, _ in entries)
+    day = datetime.date(year, 1, 1)
+    while day.year == year:
+        keys.add(ndb.Key(Report, day.strftime('%Y-%m-%d')))
+        day += datetime.timedelta(days=1)
+    reports = ndb.get_multi(sorted(keys, key=lambda key: key.id()), use_cache=False, use_memcache=False)
+    return [(report_obj.key, ReportRow.from_report(report_obj), report_obj.get_stored_derived_fields())
+            for report_obj in reports
+            if report_obj is not None and report_obj.date is not None and report_obj.date.year == year]
+
+
+def _repair_year_totals(year, expected, checked_version):
+    '''
+    Saves the recomputed totals `expected` (None if the stored ones are right) and moves the year to a
+    new version, leaving its derived data behind until `update_year_derived_data` has redone it.
+    Returns False without saving anything if the year isn't at `checked_version` anymore: it was written
+    to since it was checked, so `expected` may be out of date, and that write updates the derived data.
+    '''
+    @ndb.transactional
+    def txn():
+        key = YearTotals.key_for_year(year)
+        totals = key.get()
+        if (totals.version if totals is not None else None) != checked_version:
+            return False
+        totals = totals or YearTotals(key=key)
+        if expected is not None:
+            for field in YEAR_TOTALS_FIELDS:
+                setattr(totals, field, getattr(expected, field))
+        # Drops every instance's cached index of the year and moves its stamp
+        totals.version += 1
+        totals.put()
+        return True
+    return txn()
+
+
+def _check_year(year, entries, repair, summary):
+    '''
+    `entries` are (key, ReportRow, stored yearly numbers) for every report of `year`, as the query saw
+    them. A repair reads them again first.
+    '''
+    if repair:
+        # The version first: a write after it moves it, so the repair can tell it's out of date
+        checked_version = _get_totals_version(year)
+        entries = _get_year_entries(year, entries)
+    rows = [row for _, row, _ in entries]
+    context = ReportContext(year, reports=rows)
+    stale_reports = _check_report_fields(entries, context, summary)
+    expected_totals = _check_year_totals(year, rows, summary)
+    stale_rollups = _check_rollups(year, context, summary)
+    stale_index = _check_cached_index(year, context, summary)
+    derived_behind = _check_derived_version(year, summary)
+    summary.years_checked += 1
+    if not repair:
+        return
+    if stale_reports or expected_totals is not None or stale_rollups or derived_behind:
+        if _repair_year_totals(year, expected_totals, checked_version):
+            # Rewrites the yearly numbers of every report of the year and its rollups against the repaired
+            # totals, and only then marks them current, the same as after any write
+            update_year_derived_data_or_retry(year)
+            if expected_totals is not None:
+                summary.repaired['year totals'] += 1
+            for _, kind in stale_reports:
+                summary.repaired[kind] += 1
+            summary.repaired['month rollups'] += len(stale_rollups)
+            if derived_behind:
+                summary.repaired['derived data behind'] += 1
+        else:
+            logging.warning('Not repairing %d, it was written to while it was being checked', year)
+    if stale_index:
+        with report._year_indexes_lock:
+            report._year_indexes.pop(report.get_year_index_cache_key(year), None)
+        summary.repaired['cached year index'] += 1
+
+
+def check(repair=False, batch_size=bulk.EXPORT_BATCH_SIZE):
+    '''
+    Checks (and with `repair`, fixes) everything derived from the reports. Reports are read
+    `batch_size` at a time and only one year of them is held in memory, as ReportRows.
+    Returns a CheckSummary.
+    '''
+    summary = CheckSummary(repair)
+    checked_years = set()
+    year = None
+    entries = []
+    for report_obj in bulk.iter_reports(batch_size):
+        summary.reports_checked += 1
+        if report_obj.date is None:
+            summary.add_discrepancy('report without a date', report_obj.key.id())
+            continue
+        if report_obj.date.year != year:
+            if year is not None:
+                _check_year(year, entries, repair, summary)
+                checked_years.add(year)
+            year = report_obj.date.year
+            entries = []
+        entries.append((report_obj.key, ReportRow.from_report(report_obj), report_obj.get_stored_derived_fields()))
+    if year is not None:
+        _check_year(year, entries, repair, summary)
+        checked_years.add(year)
+    # Years that have totals but no reports (anymore)
+    for totals_key in YearTotals.query().iter(keys_only=True):
+        totals_year = int(totals_key.id())
+        if totals_year not in checked_years:
+            _check_year(totals_year, [], repair, summary)
+    if repair and summary.discrepancies:
+        page_cache.invalidate_all()
+    return summary.finish()
+
+
+def repair_task(namespace):
+    ''' Deferred task that runs `check(repair=True)` in the namespace (location) it was started from '''
+    namespace_manager.set_namespace(namespace)
+    summary = check(repair=True)
+    logging.info('Consistency repair of namespace %r:\n%s', namespace, summary.as_text())
@@ -0,0 +1,85 @@
+'''
+Restaurant locations. Each location keeps its reports, goals, totals and rollups in its own datastore
+namespace (memcache is namespaced the same way), so the rest of the app only ever sees one location.
+
+The original location lives in the default namespace and keeps the unprefixed URLs. Every other
+location is registered as a `Location` and served under /l/<location>/..., e.g. /l/shibuya/stats:
+`LocationMiddleware` strips the prefix and switches the request to that location's namespace, and
+templates build links with `url` so they stay within the location.
+'''
+import re
+
+import webob.exc
+from google.appengine.api import namespace_manager
+from google.appengine.ext import ndb
+
+
+DEFAULT_LOCATION = ''
+DEFAULT_LOCATION_NAME = 'Main'
+URL_PREFIX = '/l/'
+# Also a valid datastore namespace
+LOCATION_ID_RE = re.compile(r'^[a-z0-9][a-z0-9-]{0,49}$')
+LOCATION_PATH_RE = re.compile(r'^/l/([^/]+)(/.*)?$')
+
+
+class Location(ndb.Model):
+    '''
+    A location other than the default one, keyed by its id (which is also its namespace and URL prefix).
+    Always stored in the default namespace.
+    '''
+    name = ndb.StringProperty(default='')
+
+    @staticmethod
+    def key_for_id(location_id):
+        return ndb.Key(Location, location_id, namespace=DEFAULT_LOCATION)
+
+
+def get_locations():
+    ''' [(location id, name)] of every location, the default one first '''
+    keys = Location.query(namespace=DEFAULT_LOCATION).fetch(keys_only=True)
+    # Entities from a query can be stale, gets aren't
+    locations = [location for location in ndb.get_multi(keys) if location is not None]
+    return [(DEFAULT_LOCATION, DEFAULT_LOCATION_NAME)] + sorted(
+        (location.key.id(), location.name or location.key.id()) for location in locations)
+
+
+def add_location(location_id, name):
+    ''' Registers a location. Raises ValueError if `location_id` can't be used. '''
+    if not LOCATION_ID_RE.match(location_id):
+        raise ValueError('Location ids are lowercase letters, digits and dashes')
+    Location(key=Location.key_for_id(location_id), name=name).put()
+
+
+def get_current_location():
+    return namespace_manager.get_namespace()
+
+
+def url(path, location_id=None):
+    ''' `path` (i.e. "/stats") within `location_id`, by default the location of the current request '''
+    if location_id is None:
+        location_id = get_current_location()
+    if location_id == DEFAULT_LOCATION:
+        return path
+    return URL_PREFIX + location_id + path
+
+
+class LocationMiddleware(object):
+    '''
+    WSGI middleware that serves /l/<location>/<path> as <path> in the namespace of <location>, and
+    everything else in the default namespace. Unknown locations are a 404.
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        match = LOCATION_PATH_RE.match(environ.get('PATH_INFO', ''))
+        if match is None:
+            namespace_manager.set_namespace(DEFAULT_LOCATION)
+            return self.app(environ, start_response)
+        location_id = match.group(1)
+        if not LOCATION_ID_RE.match(location_id) or Location.key_for_id(location_id).get() is None:
+            return webob.exc.HTTPNotFound('No location {}'.format(location_id))(environ, start_response)
+        namespace_manager.set_namespace(location_id)
+        environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + URL_PREFIX + location_id
+        environ['PATH_INFO'] = match.group(2) or '/'
+        return self.app(environ, start_response)
@@ -1,20 +1,102 @@
-import endpoints
+import assets
+import hashlib
 import jinja2
+import json
+import locations
 import logging
 import os
+import page_cache
+import perf
+import report_fields
+import threading
 import webapp2
 
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 from google.appengine.ext import ndb
 from datetime import datetime, date
 import datetime
-from report import Report
+from report import Report, ReportContext, ReportRow, YearIndex, YearTotals, save_report, delete_report, get_report_list_page
+from report import get_recent_reports
+from report import update_year_derived_data_or_retry
+from report import REPORT_ROW_PROJECTION
+# NumPy (stats) and the modules that use it (rollups, bulk, consistency) are imported by the handlers
+# that need them, so the pages most instances start on don't pay for importing it.
 
 
-JINJA_ENVIRONMENT = jinja2.Environment(
-    loader=jinja2.FileSystemLoader(os.path.dirname(__file__)),
-    extensions=['jinja2.ext.autoescape'],
-    autoescape=True,
-)
+TEMPLATES_DIR = os.path.dirname(os.path.abspath(__file__))
+# Built by tools/compile_templates.py before deploying
+COMPILED_TEMPLATES_DIR = os.path.join(TEMPLATES_DIR, 'compiled_templates')
+# {template name: hash of the source it was compiled from}, written along with the compiled templates
+COMPILED_TEMPLATES_SOURCES_PATH = os.path.join(COMPILED_TEMPLATES_DIR, 'sources.json')
+
+
+def make_jinja_environment(loader):
+    environment = jinja2.Environment(
+        loader=loader,
+        extensions=['jinja2.ext.autoescape'],
+        autoescape=True,
+    )
+    # Lets the perf middleware tell how much of a request went into rendering
+    environment.template_class = perf.TimedTemplate
+    environment.globals['asset_url'] = assets.asset_url
+    environment.globals['asset_srcset'] = assets.asset_srcset
+    environment.globals['url'] = locations.url
+    return environment
+
+
+def get_template_source_hash(name):
+    with open(os.path.join(TEMPLATES_DIR, name), 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class CompiledTemplateLoader(jinja2.ModuleLoader):
+    '''
+    ModuleLoader for only the templates in `names`, i.e. the ones whose source hasn't changed since they
+    were compiled. Anything else is left to the next loader.
+    '''
+    def __init__(self, path, names):
+        super(CompiledTemplateLoader, self).__init__(path)
+        self.names = names
+
+    def load(self, environment, name, globals=None):
+        if name not in self.names:
+            raise jinja2.TemplateNotFound(name)
+        return super(CompiledTemplateLoader, self).load(environment, name, globals)
+
+
+def make_template_loader():
+    '''
+    Loads the precompiled templates if they were built, so a new instance doesn't have to parse and
+    compile every template it renders. Not on the dev server, where the templates are being edited.
+    A template whose source no longer matches what was compiled (i.e. the compile step wasn't rerun
+    after editing it) is read from its source instead.
+    '''
+    filesystem_loader = jinja2.FileSystemLoader(TEMPLATES_DIR)
+    if os.environ.get('SERVER_SOFTWARE', '').startswith('Development') or not os.path.isfile(COMPILED_TEMPLATES_SOURCES_PATH):
+        return filesystem_loader
+    try:
+        with open(COMPILED_TEMPLATES_SOURCES_PATH) as f:
+            compiled_hashes = json.load(f)
+    except ValueError:
+        logging.exception('Ignoring the compiled templates, %s is unreadable', COMPILED_TEMPLATES_SOURCES_PATH)
+        return filesystem_loader
+    fresh_names = set()
+    for name in get_template_names():
+        if compiled_hashes.get(name) == get_template_source_hash(name):
+            fresh_names.add(name)
+        else:
+            logging.warning('Not using the compiled %s, its source changed since it was compiled', name)
+    return jinja2.ChoiceLoader([CompiledTemplateLoader(COMPILED_TEMPLATES_DIR, fresh_names), filesystem_loader])
+
+
+def get_template_names():
+    ''' Every page template, i.e. the .html files next to this module '''
+    return sorted(name for name in os.listdir(TEMPLATES_DIR) if name.endswith('.html'))
+
+
+JINJA_ENVIRONMENT = make_jinja_environment(make_template_loader())
 
 
 def get_working_days_left_in_year(date_obj):
@@ -29,70 +111,28 @@ def get_working_days_left_in_year(date_obj):
     return working_days_until_year_end
 
 
-def get_reports_this_year(force_datetime=None):
-    if force_datetime is not None and len(force_datetime) > 0:
-        this_datetime = force_datetime
-    else:
-        this_datetime = datetime.datetime.now()
-    this_year = this_datetime.year
-    this_month = this_datetime.month
-    january_1_this_year = datetime.datetime.strptime('01/01/{}'.format(this_year), '%m/%d/%Y')
-    december_31_this_year = datetime.datetime.strptime('12/31/{}'.format(this_year), '%m/%d/%Y')
-    reports_this_year = [report for report in Report.query(ndb.AND(
-        Report.date >= january_1_this_year,
-        Report.date <= december_31_this_year,
-    )) if report.is_finalized()]
-    return reports_this_year
-
-
-def get_reports_this_month(month_num):
-    this_datetime = datetime.datetime.now()
-    this_year = this_datetime.year
-    month_beginning = datetime.datetime.strptime('{:02d}/01/{:04d}'.format(month_num, this_year), '%m/%d/%Y')
+def get_reports_this_month(month_num, year=None):
+    ''' Finalized reports of month `month_num` of `year` (this year by default), as ReportRows '''
+    if year is None:
+        year = datetime.datetime.now().year
+    month_beginning = datetime.datetime(year, month_num, 1)
     if month_num < 12:
-        next_month_beginning = datetime.datetime.strptime('{:02d}/01/{:04d}'.format(month_num + 1, this_year), '%m/%d/%Y')
+        next_month_beginning = datetime.datetime(year, month_num + 1, 1)
     else:
-        next_month_beginning = datetime.datetime.strptime('01/01/{}'.format(this_year + 1), '%m/%d/%Y')
-    reports_this_month = [report for report in Report.query(ndb.AND(
+        next_month_beginning = datetime.datetime(year + 1, 1, 1)
+    reports_this_month = [ReportRow.from_report(report) for report in Report.query(ndb.AND(
         Report.date >= month_beginning,
         Report.date < next_month_beginning,
-    )) if report.is_finalized()]
+    )).order(-Report.date).iter(projection=REPORT_ROW_PROJECTION) if report.is_finalized()]
     return reports_this_month
 
 
-def calculate_dream_dicts(month_reports, goal_dict):
-    '''
-    * {Lunch, Dinner} x {Dreams, Dreamers, Customers} achievement rates, given the goals in `goal_dict`.
-    * goal_dict example: {'lunch_dreams': 50, 'lunch_dreamers': '30', 'lunch_customers': 80}, ...}
-    '''
-    actual_dict = {key: 0 for key in goal_dict}
-    num_lunch_reports = 0
-    num_dinner_reports = 0
-    for report in month_reports:
-        if report.lunch_customers_today > 0 and report.lunch_dreamers > 0 and report.lunch_dreams > 0:
-            num_lunch_reports += 1
-            actual_dict['lunch_customers_today'] += report.lunch_customers_today
-            actual_dict['lunch_dreamers'] += report.lunch_dreamers
-            actual_dict['lunch_dreams'] += report.lunch_dreams
-        if report.dinner_customers_today > 0 and report.dinner_dreamers > 0 and report.dinner_dreams > 0:
-            num_dinner_reports += 1
-            actual_dict['dinner_customers_today'] += report.dinner_customers_today
-            actual_dict['dinner_dreamers'] += report.dinner_dreamers
-            actual_dict['dinner_dreams'] += report.dinner_dreams
-
-    expected_dict = {}
-    for key in goal_dict:
-        if key.startswith('lunch'):
-            expected_dict[key] = num_lunch_reports * goal_dict[key]
-        if key.startswith('dinner'):
-            expected_dict[key] = num_dinner_reports * goal_dict[key]
-    return (actual_dict, expected_dict)
-
-
 class Goals(ndb.Model):
     yearly_dream_goal = ndb.IntegerProperty(default=0)
     year_goal = ndb.StringProperty(default="")
     month_goal = ndb.StringProperty(default="")
+    # Bumped by every edit, see `get_goals`
+    version = ndb.IntegerProperty(default=0)
 
     def daily_dream_goal(self, working_days_left_in_year=None, datetime_obj=None):
         if datetime_obj is None:
@@ -101,44 +141,242 @@ class Goals(ndb.Model):
             working_days_left_in_year = get_working_days_left_in_year(datetime_obj.date())
         if working_days_left_in_year == 0:
             return 0.
-        dreams_remaining = max(0, self.yearly_dream_goal - Report.get_dreams_for_year(datetime_obj))
+        dreams_remaining = max(0, self.yearly_dream_goal - YearTotals.get_for_year(datetime_obj.year).dreams)
         return dreams_remaining / working_days_left_in_year
 
     @property
     def customers_this_year(self):
-        return Report.get_customers_for_year(datetime.datetime.now().date())
+        return YearTotals.get_for_year(datetime.datetime.now().year).customers
 
     @property
     def dreams_this_year(self):
-        return Report.get_dreams_for_year(datetime.datetime.now().date())
+        return YearTotals.get_for_year(datetime.datetime.now().year).dreams
 
     @property
     def dreamers_this_year(self):
-        return Report.get_dreamers_for_year(datetime.datetime.now().date())
+        return YearTotals.get_for_year(datetime.datetime.now().year).dreamers
 
 
-def get_goals():
+GOALS_VERSION_KEY = 'goals:version'
+
+# The Goals are shared by every request on this instance (app.yaml has `threadsafe: yes`), so treat
+# the cached entities as read-only. Edits go through `load_goals`.
+_goals_cache_lock = threading.Lock()
+# Namespace (i.e. location) -> Goals
+_cached_goals = {}
+
+
+def load_goals():
+    ''' Reads the Goals straight from the datastore. Use this (not `get_goals`) to get a copy to edit. '''
+    return load_goals_async().get_result()
+
+
+@ndb.tasklet
+def load_goals_async():
     goals_key = ndb.Key(Goals, "goals")
-    goals = goals_key.get()
+    goals = yield goals_key.get_async()
     if goals is None:
-        return Goals(id="goals")
-    return goals
+        raise ndb.Return(Goals(id="goals"))
+    raise ndb.Return(goals)
+
+
+def get_goals():
+    '''
+    The current Goals, from the instance cache as long as its version matches the one in memcache.
+    Other instances find out about an edit through that memcache entry.
+    '''
+    return get_goals_async().get_result()
+
+
+@ndb.tasklet
+def get_goals_async():
+    context = ndb.get_context()
+    version = yield context.memcache_get(GOALS_VERSION_KEY)
+    goals = _cached_goals.get(namespace_manager.get_namespace())
+    if goals is not None and version is not None and goals.version == version:
+        raise ndb.Return(goals)
+    goals = yield load_goals_async()
+    # Only fills in a missing entry: a `set` here could put back an older version than the one `save_goals`
+    # just wrote, if this load happened before that edit
+    yield context.memcache_add(GOALS_VERSION_KEY, goals.version)
+    with _goals_cache_lock:
+        _cached_goals[goals.key.namespace()] = goals
+    raise ndb.Return(goals)
+
+
+def save_goals(goals):
+    goals.version += 1
+    goals.put()
+    memcache.set(GOALS_VERSION_KEY, goals.version)
+    with _goals_cache_lock:
+        _cached_goals[goals.key.namespace()] = goals
+
+
+DEFAULT_REPORT_PAGE_SIZE = 50
+MAX_REPORT_PAGE_SIZE = 500
+
+
+def get_report_list_page_from_request(handler):
+    '''
+    Reads the `cursor` and `page_size` parameters and fetches that page of reports, 400ing on a bad cursor.
+    A `page_size` that isn't a number falls back to the default.
+    '''
+    try:
+        page_size = get_integer_input(handler.request, 'page_size') or DEFAULT_REPORT_PAGE_SIZE
+    except ValueError:
+        page_size = DEFAULT_REPORT_PAGE_SIZE
+    page_size = min(max(1, page_size), MAX_REPORT_PAGE_SIZE)
+    try:
+        return get_report_list_page(handler.request.get('cursor', None), page_size)
+    except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+        handler.abort(400, detail='Invalid cursor')
 
 
 class ViewAllReportsHandler(webapp2.RequestHandler):
     '''
-    Handler to view a list of all the existing daily reports
+    Handler to view a list of all the existing daily reports, newest first, a page at a time.
+        GET with optional `page_size` and `cursor` (from the "Older reports" link)
     '''
     def get(self):
         template_values = {}
-        all_reports = [x for x in Report.query().iter()]
-        sorted_reports = sorted(all_reports, key=lambda x: x.date, reverse=True)
-        template_values['reports'] = sorted_reports
+        reports, next_cursor = get_report_list_page_from_request(self)
+        template_values['reports'] = reports
+        template_values['next_cursor'] = next_cursor
+        template_values['page_size'] = self.request.get('page_size', '')
 
         template = JINJA_ENVIRONMENT.get_template('reports.html')
         self.response.write(template.render(template_values))
 
 
+def write_json(handler, etag, make_body):
+    '''
+    Answers with the JSON of `make_body()`, or with a 304 if the client already has the version `etag`
+    stands for. `etag` has to change whenever the body would, i.e. built from the data version stamps.
+    '''
+    # A deploy can change what the body looks like
+    etag = '"{}:{}"'.format(os.environ.get('CURRENT_VERSION_ID', ''), etag)
+    handler.response.headers['ETag'] = etag
+    handler.response.headers['Cache-Control'] = 'private, no-cache'
+    if_none_match = handler.request.headers.get('If-None-Match', '')
+    if if_none_match == '*' or etag in [value.strip() for value in if_none_match.split(',')]:
+        handler.response.status = 304
+        return
+    handler.response.headers['Content-Type'] = 'application/json'
+    handler.response.write(json.dumps(make_body(), sort_keys=True))
+
+
+def get_all_years_version():
+    ''' Stamp that changes whenever any report changes: the YearTotals stamp of every year '''
+    # Entities from a query can be stale, gets aren't
+    all_totals = ndb.get_multi(YearTotals.query().fetch(keys_only=True))
+    versions = ['{}.{}'.format(totals.key.id(), totals.stamp) for totals in all_totals if totals is not None]
+    return hashlib.sha1(','.join(sorted(versions))).hexdigest()
+
+
+def get_report_year(handler, date_string):
+    ''' The year of the report date in the URL, or a 404 if it isn't a real date (i.e. "2018-13-45") '''
+    try:
+        return get_date_obj(date_string).year
+    except ValueError:
+        handler.abort(404, detail='No report found for {}'.format(date_string))
+
+
+def get_report_json(report, derived):
+    ''' `report` and its yearly numbers (`derived`) as a JSON-able dict '''
+    import bulk
+    report_json = {}
+    for field in bulk.EXPORT_FIELDS:
+        value = getattr(report, field)
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            value = value.strftime('%Y-%m-%d')
+        elif isinstance(value, datetime.time):
+            value = value.strftime('%H:%M')
+        report_json[field] = value
+    for field in ['dinner_customers_today', 'dinner_dreams', 'dinner_dreamers']:
+        report_json[field] = getattr(report, field)
+    report_json.update(derived)
+    return report_json
+
+
+class ReportListApiHandler(webapp2.RequestHandler):
+    '''
+    JSON version of ViewAllReportsHandler. GET only, same parameters.
+    '''
+    def get(self):
+        def make_body():
+            reports, next_cursor = get_report_list_page_from_request(self)
+            end_times = [report.get_end_time() for report in reports]
+            return {
+                'reports': [{
+                    'date': report.date_string,
+                    'customers': report.get_customers_today(),
+                    'dreams': report.get_dreams(),
+                    'dreamers': report.get_dreamers(),
+                    'end_time': end_time.strftime('%H:%M') if end_time is not None else None,
+                } for report, end_time in zip(reports, end_times)],
+                'next_cursor': next_cursor,
+            }
+        write_json(self, 'reports:' + get_all_years_version(), make_body)
+
+
+class ReportApiHandler(webapp2.RequestHandler):
+    '''
+    A report and its yearly numbers as JSON. GET only.
+    '''
+    def get(self, date_string):
+        # The yearly numbers change with any report of the year, so the year's stamp covers everything
+        totals = YearTotals.get_for_year(get_report_year(self, date_string))
+
+        def make_body():
+            report = ndb.Key(Report, date_string).get()
+            if report is None:
+                self.abort(404, detail='No report found for {}'.format(date_string))
+            return get_report_json(report, report.get_current_derived_fields(totals))
+        write_json(self, 'report:{}:{}'.format(date_string, totals.stamp), make_body)
+
+
+class StatsApiHandler(webapp2.RequestHandler):
+    '''
+    The monthly stats of a year as JSON, from the month rollups. GET with ?year=2018 (defaults to this year).
+    '''
+    def get(self):
+        import rollups
+        import stats
+        year = get_year_input(self, 'year') or datetime.datetime.now().year
+        totals = YearTotals.get_for_year(year)
+
+        def make_body():
+            month_rollups = rollups.get_rollups_for_years([year])[year]
+            return {
+                'year': year,
+                'months': stats.format_monthly_stats([rollup.to_dict() for rollup in month_rollups]),
+            }
+        write_json(self, 'stats:{}:{}'.format(year, totals.stamp), make_body)
+
+
+class GoalsApiHandler(webapp2.RequestHandler):
+    '''
+    The goals and how this year is doing against them, as JSON. GET only.
+    '''
+    def get(self):
+        today = datetime.datetime.now()
+        goals = get_goals()
+        totals = YearTotals.get_for_year(today.year)
+
+        def make_body():
+            return {
+                'yearly_dream_goal': goals.yearly_dream_goal,
+                'year_goal': goals.year_goal,
+                'month_goal': goals.month_goal,
+                'daily_dream_goal': goals.daily_dream_goal(),
+                'customers_this_year': goals.customers_this_year,
+                'dreams_this_year': goals.dreams_this_year,
+                'dreamers_this_year': goals.dreamers_this_year,
+            }
+        # The daily dream goal also depends on how many days are left in the year
+        write_json(self, 'goals:{}:{}:{}'.format(goals.version, totals.version, today.strftime('%Y-%m-%d')), make_body)
+
+
 class ViewReportHandler(webapp2.RequestHandler):
     '''
     Handler to view details about a single report
@@ -147,60 +385,60 @@ class ViewReportHandler(webapp2.RequestHandler):
         '''
         Get corresponding report from date_string, if it exists. if not, 404
         '''
-        template_values = {}
-        report_key = ndb.Key(Report, date_string)
-        current_report = report_key.get()
-        if current_report is None:
-            raise endpoints.NotFoundException("No report found for {}".format(date_string))
-        report_dict = create_report_dict_from_report_obj(current_report)
-        today_datetime = datetime.datetime.now()
-        goals = get_goals()
-        template_values['goals'] = goals
-        template_values['report'] = report_dict
-        template_values['today_date_string'] = today_datetime.strftime('%Y-%m-%d')
-        template_values['hidetitleimg'] = True
-        template = JINJA_ENVIRONMENT.get_template('report.html')
-        self.response.write(template.render(template_values))
+        # The page only changes with the goals and the reports of its year, so their stamps key the cache
+        futures = [get_goals_async(), YearTotals.get_for_year_async(get_report_year(self, date_string))]
+        goals, totals = [future.get_result() for future in futures]
+        page_key = page_cache.report_page_key(date_string, goals, totals)
+        html = page_cache.get_page(page_key)
+        if html is None:
+            template_values = {}
+            current_report = ndb.Key(Report, date_string).get()
+            if current_report is None:
+                self.abort(404, detail='No report found for {}'.format(date_string))
+            # Saved reports carry their yearly numbers, the year only needs loading if they're behind
+            report_dict = create_report_dict_from_report_obj(current_report, derived=current_report.get_current_derived_fields(totals))
+            today_datetime = datetime.datetime.now()
+            template_values['goals'] = goals
+            template_values['report'] = report_dict
+            template_values['today_date_string'] = today_datetime.strftime('%Y-%m-%d')
+            template_values['hidetitleimg'] = True
+            template = JINJA_ENVIRONMENT.get_template('report.html')
+            html = template.render(template_values)
+            # Until the stored yearly numbers catch up, they're recomputed from a query that can lag behind
+            if totals.derived_is_current:
+                page_cache.set_page(page_key, html)
+        self.response.write(html)
 
 
 '''
 Helper functions for `get_report_from_request`
 '''
 def get_integer_input(request, key, default=None):
-    val = request.get(key, default)
-    if val is not None and val != '':
-        val = val.replace('$', '')
-        int_val = int(val)
-    else:
-        int_val = None
-    return int_val
+    return report_fields.parse_int(request.get(key, default))
 
 
-def get_time_obj(end_time):
-    if end_time:
-        if ':' in end_time:
-            end_time_obj = datetime.datetime.strptime(end_time, '%H:%M').time()  # deal w/ am/pm?
-        else:
-            end_time_obj = datetime.datetime.strptime(end_time, '%H%M').time()  # deal w/ am/pm?
-    else:
-        end_time_obj = None
-    return end_time_obj
+# Years the stats pages and APIs accept
+MIN_YEAR = 1900
+MAX_YEAR = 2100
 
 
-def get_date_obj(date):
-    if date:
-        date_obj = datetime.datetime.strptime(date, '%Y-%m-%d')
-    else:
-        date_obj = None
-    return date_obj
+def get_year_input(handler, key):
+    ''' The year in the `key` parameter, None if it's missing. 400s if it isn't between MIN_YEAR and MAX_YEAR. '''
+    try:
+        year = get_integer_input(handler.request, key)
+    except ValueError:
+        handler.abort(400, detail='Invalid {}'.format(key))
+    if year is not None and not MIN_YEAR <= year <= MAX_YEAR:
+        handler.abort(400, detail='{} has to be between {} and {}'.format(key, MIN_YEAR, MAX_YEAR))
+    return year
 
 
-def get_old_report(date):
-    old_report = None
-    if date is not None and date != '':
-        old_report_key = ndb.Key(Report, date)
-        old_report = old_report_key.get()
-    return old_report
+def get_time_obj(end_time):
+    return report_fields.parse_time(end_time)
+
+
+def get_date_obj(date):
+    return report_fields.parse_date(date)
 
 
 def _populate_dinner_totals(report):
@@ -212,98 +450,41 @@ def _populate_dinner_totals(report):
         report.dinner_dreamers = report.dreamers - report.lunch_dreamers
 
 
-def _populate_report_fields_from_request(report, request):
-    # Parse and populate date/time fields
-    date_string = request.get('date', '')
-    end_time_dishwasher = request.get('end_time_dishwasher', '')
-    end_time_host = request.get('end_time_host', '')
-    end_time_kitchen = request.get('end_time_kitchen', '')
-    report.date = get_date_obj(date_string)
-    report.end_time_dishwasher = get_time_obj(end_time_dishwasher)
-    report.end_time_host = get_time_obj(end_time_host)
-    report.end_time_kitchen = get_time_obj(end_time_kitchen)
-
-    # They want to input lunch and total. So we compute dinner manually.
-    report.lunch_customers_today = get_integer_input(request, 'lunch_customers_today')
-    report.customers_today = get_integer_input(request, 'customers_today')
-    report.lunch_dreams = get_integer_input(request, 'lunch_dreams')
-    report.dreams = get_integer_input(request, 'dreams')
-    report.lunch_dreamers = get_integer_input(request, 'lunch_dreamers')
-    report.dreamers = get_integer_input(request, 'dreamers')
-
-    report.working_dishwasher = request.get('working_dishwasher', '')
-    report.working_host = request.get('working_host', '')
-    report.working_kitchen2 = request.get('working_kitchen2', '')
-    report.working_kitchen = request.get('working_kitchen', '')
-    report.supporting_members = request.get('supporting_members', '')
-    report.visiting_members = request.get('visiting_members', '')
-
-    report.total_bowls = get_integer_input(request, 'total_bowls')
-    report.total_cups = get_integer_input(request, 'total_cups')
-    report.chopsticks_missing = get_integer_input(request,'chopsticks_missing')
-    report.money_off_by = get_integer_input(request, 'money_off_by')
-    report.positive_cycle = get_integer_input(request, 'positive_cycle')
-    report.misc_notes = request.get('misc_notes', '')
-
-def get_report_from_request(request, prev_date=None):
+def get_report_from_request(request, prev_date=None, current_goals=None):
     report = Report(id=request.get('date', ''))
-    _populate_report_fields_from_request(report, request)
+    report_fields.populate_from_form(report, request)
     _populate_dinner_totals(report)
 
     # Snapshot the goals. Maybe this should eventually be removed but it's pretty easy logic since the goals are fairly static.
-    current_goals = get_goals()
+    if current_goals is None:
+        current_goals = get_goals()
     report.month_goal = current_goals.month_goal
     report.year_goal = current_goals.year_goal
     report.yearly_dream_goal = current_goals.yearly_dream_goal
     return report
 
-def create_report_dict_from_report_obj(current_report):
-    # TODO: optimize -- if you call "get_...()" twice it's twice the database calls!
-    report_dict = {
-        'month_goal': current_report.month_goal if current_report.month_goal is not None else '',
-        'year_goal': current_report.year_goal if current_report.year_goal is not None else '',
-
-        'datetime_obj': current_report.date,
-        'date': current_report.date.strftime('%Y-%m-%d') if current_report.date is not None else '',
-        'date_string': current_report.date.strftime('%Y-%m-%d') if current_report.date is not None else '',
-        'readable_date_string': current_report.readable_date_string if current_report.readable_date_string is not None else '',
-
-        'lunch_customers_today': current_report.lunch_customers_today if current_report.lunch_customers_today is not None else '',
-        'dinner_customers_today': current_report.dinner_customers_today if current_report.dinner_customers_today is not None else '',
-        'lunch_dreams': current_report.lunch_dreams if current_report.lunch_dreams is not None else '',
-        'dinner_dreams': current_report.dinner_dreams if current_report.dinner_dreams is not None else '',
-        'lunch_dreamers': current_report.lunch_dreamers if current_report.lunch_dreamers is not None else '',
-        'dinner_dreamers': current_report.dinner_dreamers if current_report.dinner_dreamers is not None else '',
-
-        'working_dishwasher': current_report.working_dishwasher if current_report.working_dishwasher is not None else '',
-        'working_host': current_report.working_host if current_report.working_host is not None else '',
-        'working_kitchen2': current_report.working_kitchen2 if current_report.working_kitchen2 is not None else '',
-        'working_kitchen': current_report.working_kitchen if current_report.working_kitchen is not None else '',
-        'working_members': current_report.working_members if current_report.working_members is not None else '',
-        'supporting_members': current_report.supporting_members if current_report.supporting_members is not None else '',
-        'visiting_members': current_report.visiting_members if current_report.visiting_members is not None else '',
-        'end_time': current_report.get_end_time().strftime('%H:%M') if current_report.get_end_time() is not None else '',
-        'end_time_dishwasher': current_report.end_time_dishwasher.strftime('%H:%M') if current_report.end_time_dishwasher is not None else '',
-        'end_time_host': current_report.end_time_host.strftime('%H:%M') if current_report.end_time_host is not None else '',
-        'end_time_kitchen': current_report.end_time_kitchen.strftime('%H:%M') if current_report.end_time_kitchen is not None else '',
-        'positive_cycle': current_report.positive_cycle if current_report.positive_cycle is not None else '',
-        'total_bowls': current_report.total_bowls if current_report.total_bowls is not None else '',
-        'total_cups': current_report.total_cups if current_report.total_cups is not None else '',
-        'chopsticks_missing': current_report.chopsticks_missing if current_report.chopsticks_missing is not None else '',
-        'money_off_by': current_report.money_off_by if current_report.money_off_by is not None else '',
-        'misc_notes': current_report.misc_notes if current_report.misc_notes is not None else '',
-        'customers_today': current_report.get_customers_today() if current_report.get_customers_today() is not None else '',
-        'dreams': current_report.get_dreams() if current_report.get_dreams() is not None else '',
-        'dreamers': current_report.get_dreamers() if current_report.get_dreamers() is not None else '',
-        'daily_dream_goal': current_report.get_daily_dream_goal() or '',
-        'yearly_dream_goal': current_report.yearly_dream_goal or '',
-        'customers_this_year': current_report.get_customers_this_year() if current_report.get_customers_this_year() is not None else '',
-        'dreams_this_year': current_report.get_dreams_this_year() if current_report.get_dreams_this_year() is not None else '',
-        'dreamers_this_year': current_report.get_dreamers_this_year() if current_report.get_dreamers_this_year() is not None else '',
-        'perfect_money_marathon': current_report.get_perfect_money_marathon()  if current_report.get_perfect_money_marathon() is not None else  '',
-        'achievement_rate': '{:.2f}%'.format(current_report.get_achievement_rate()) if \
-                current_report.get_achievement_rate() is not None else '',
-    }
+def create_report_dict_from_report_obj(current_report, context=None, derived=None):
+    '''
+    Flattens `current_report` into the dict the templates display. All the yearly numbers come out of
+    `derived` (i.e. Report.get_current_derived_fields()) if it's passed in, otherwise out of `context`
+    (a ReportContext for the report's year), which is loaded here if it isn't passed in either.
+    '''
+    if derived is None:
+        if context is None:
+            context = ReportContext.for_report(current_report)
+        derived = context.get_derived_fields(current_report)
+    report_dict = report_fields.to_display_dict(current_report)
+    readable_date_string = current_report.readable_date_string
+    report_dict['datetime_obj'] = current_report.date
+    report_dict['date_string'] = report_dict['date']
+    report_dict['readable_date_string'] = readable_date_string if readable_date_string is not None else ''
+    report_dict['daily_dream_goal'] = derived['daily_dream_goal'] or ''
+    report_dict['customers_this_year'] = derived['customers_this_year']
+    report_dict['dreams_this_year'] = derived['dreams_this_year']
+    report_dict['dreamers_this_year'] = derived['dreamers_this_year']
+    report_dict['perfect_money_marathon'] = derived['perfect_money_marathon']
+    achievement_rate = derived['achievement_rate']
+    report_dict['achievement_rate'] = '{:.2f}%'.format(achievement_rate) if achievement_rate is not None else ''
     return report_dict
 
 
@@ -320,9 +501,15 @@ class CreateReportHandler(webapp2.RequestHandler):
         if date_string == '':
             date_string = (datetime.datetime.now() - datetime.timedelta(hours=12)).strftime('%Y-%m-%d')
         current_report_key = ndb.Key(Report, date_string)
-        request_report = get_report_from_request(self.request)
+        # Fetch everything the form needs at once; none of these depend on each other
+        futures = [
+            current_report_key.get_async(),
+            get_goals_async(),
+            ReportContext.load_async(get_date_obj(date_string).year),
+        ]
+        past_report, goals, context = [future.get_result() for future in futures]
+        request_report = get_report_from_request(self.request, current_goals=goals)
         if date_string:
-            past_report = current_report_key.get()
             logging.info('past_report: {}'.format(past_report))
             if past_report is not None:
                 past_report.update(request_report)
@@ -332,9 +519,9 @@ class CreateReportHandler(webapp2.RequestHandler):
         else:
             current_report = request_report
         assert current_report is not None
-        report_dict = create_report_dict_from_report_obj(current_report)
+        report_dict = create_report_dict_from_report_obj(current_report, context)
         template_values['report'] = report_dict
-        template_values['goals'] = get_goals()
+        template_values['goals'] = goals
         template_values['hidetitleimg'] = True
         self.response.write(template.render(template_values))
 
@@ -343,8 +530,8 @@ class CreateReportHandler(webapp2.RequestHandler):
         # create a new Report object and save it to ndb
         old_date_string = self.request.get('old_date_string', None)
         new_report = get_report_from_request(self.request, prev_date=old_date_string)
-        new_report.put()
-        report_page = '/report/' + new_report.date.strftime('%Y-%m-%d')
+        save_report(new_report)
+        report_page = locations.url('/report/' + new_report.date.strftime('%Y-%m-%d'))
         self.redirect(report_page)
 
 
@@ -369,190 +556,201 @@ class PreviewReportHandler(webapp2.RequestHandler):
         self.response.write(template.render(template_values))
 
 
-class StatsHandler(webapp2.RequestHandler):
+class PreviewApiHandler(webapp2.RequestHandler):
     '''
-    Handler to view statistics about the reports. GET only.
+    What the create report form should show for the fields typed in so far, as JSON. GET with the form fields.
+    The yearly numbers are the year's cached YearIndex (i.e. the reports before this date) plus this
+    report, so nothing here scans the reports.
     '''
+    def get(self):
+        try:
+            date_obj = get_date_obj(self.request.get('date', ''))
+            if date_obj is None:
+                date_obj = datetime.datetime.now() - datetime.timedelta(hours=12)
+            futures = [get_goals_async(), ReportContext.load_async(date_obj.year)]
+            goals, context = [future.get_result() for future in futures]
+            report = get_report_from_request(self.request, current_goals=goals)
+        except ValueError as e:
+            self.abort(400, str(e))
+        derived = context.get_derived_fields(report)
+        customers_today = report.get_customers_today()
+        dreamers = report.get_dreamers()
+        if customers_today and dreamers is not None:
+            dreamer_customer_ratio = dreamers / float(customers_today)
+        else:
+            dreamer_customer_ratio = None
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({
+            'dinner_customers_today': report.dinner_customers_today,
+            'dinner_dreams': report.dinner_dreams,
+            'dinner_dreamers': report.dinner_dreamers,
+            'customers_today': customers_today,
+            'dreams': report.get_dreams(),
+            'dreamers': dreamers,
+            'dreamer_customer_ratio': dreamer_customer_ratio,
+            'daily_dream_goal': derived['daily_dream_goal'],
+            'achievement_rate': derived['achievement_rate'],
+            'customers_this_year': derived['customers_this_year'],
+            'dreams_this_year': derived['dreams_this_year'],
+            'dreamers_this_year': derived['dreamers_this_year'],
+        }, sort_keys=True))
 
-    def _make_monthly_stats_list(self, monthly_stats_list, reports_this_year):
-        for i in range(len(monthly_stats_list)):
-            monthly_stats_list[i] = {
-                'total_lunch_dreams': 0,
-                'total_dinner_dreams': 0,
-                'total_lunch_dreamers': 0,
-                'total_dinner_dreamers': 0,
-                'total_lunch_customers': 0,
-                'total_dinner_customers': 0,
-
-                'lunch_denom': 0,
-                'dinner_denom': 0,
-                'denom': 0,
-            }
-        for report in reports_this_year:
-            report.report_list = reports_this_year
-            monthly_stats_list[report.date.month - 1]['total_lunch_dreams'] += report.lunch_dreams
-            monthly_stats_list[report.date.month - 1]['total_dinner_dreams'] += report.dinner_dreams
-            monthly_stats_list[report.date.month - 1]['total_lunch_dreamers'] += report.lunch_dreamers
-            monthly_stats_list[report.date.month - 1]['total_dinner_dreamers'] += report.dinner_dreamers
-            monthly_stats_list[report.date.month - 1]['total_lunch_customers'] += report.lunch_customers_today
-            monthly_stats_list[report.date.month - 1]['total_dinner_customers'] += report.dinner_customers_today
-            monthly_stats_list[report.date.month - 1]['denom'] += 1
-            if report.lunch_dreams != 0 or report.lunch_dreamers != 0 or report.lunch_customers_today != 0:
-                monthly_stats_list[report.date.month - 1]['lunch_denom'] += 1
-            if report.dinner_dreams != 0 or report.dinner_dreamers != 0 or report.dinner_customers_today != 0:
-                monthly_stats_list[report.date.month - 1]['dinner_denom'] += 1
-        for report in reports_this_year:
-            month_dict = monthly_stats_list[report.date.month - 1]
-            denom = float(month_dict['denom'])
-            if 'average_dream_achievement_rate' not in month_dict:
-                month_dict['average_dream_achievement_rate'] = 0.0
-            month_dict['average_dream_achievement_rate'] += report.get_achievement_rate() / denom
-        for i, month_dict in enumerate(monthly_stats_list):
-            month_dict['average_dinner_dreams'] = '{:.2f}'.format(month_dict['total_dinner_dreams'] / max(1, month_dict['dinner_denom']))
-            month_dict['average_dinner_dreamers'] = '{:.2f}'.format(month_dict['total_dinner_dreamers'] / max(1, month_dict['dinner_denom']))
-            month_dict['average_dinner_customers'] = '{:.2f}'.format(month_dict['total_dinner_customers'] / max(1, month_dict['dinner_denom']))
-
-            month_dict['average_lunch_dreams'] = '{:.2f}'.format(month_dict['total_lunch_dreams'] / max(1, month_dict['lunch_denom']))
-            month_dict['average_lunch_dreamers'] = '{:.2f}'.format(month_dict['total_lunch_dreamers'] / max(1, month_dict['lunch_denom']))
-            month_dict['average_lunch_customers'] = '{:.2f}'.format(month_dict['total_lunch_customers'] / max(1, month_dict['lunch_denom']))
-
-            if 'average_dream_achievement_rate' in month_dict:
-                month_dict['average_dream_achievement_rate'] = "{:.2f}".format(month_dict['average_dream_achievement_rate'])
-            else:
-                month_dict['average_dream_achievement_rate'] = 0.0
-            month_dict['num_reports'] = month_dict['denom']
-            month_dict['month_string'] = datetime.datetime.strptime('2018-{:02d}-01'.format(i + 1), '%Y-%m-%d').strftime('%B')
-
-    def _make_dict_for_month(self, month, reports_this_year):
-        month_reports = [x for x in reports_this_year if x.date.month == month and x.is_finalized()]
-        denom = len(month_reports) if len(month_reports) > 0 else 1
-        sum_lunch_dreams = 0
-        sum_lunch_dreamers = 0
-        sum_lunch_customers = 0
-        sum_dinner_dreams = 0
-        sum_dinner_dreamers = 0
-        sum_dinner_customers = 0
-        for report in month_reports:
-            sum_lunch_dreams += report.lunch_dreams
-            sum_dinner_dreams += report.dinner_dreams
-            sum_lunch_dreamers += report.lunch_dreamers
-            sum_dinner_dreamers += report.dinner_dreamers
-            sum_lunch_customers += report.lunch_customers_today
-            sum_dinner_customers += report.dinner_customers_today
-        return {
-            'total_lunch_dreams': sum_lunch_dreams,
-            'total_dinner_dreams': sum_dinner_dreams,
-            'total_lunch_dreamers': sum_lunch_dreamers,
-            'total_dinner_dreamers': sum_dinner_dreamers,
-            'total_lunch_customers': sum_lunch_customers,
-            'total_dinner_customers': sum_dinner_customers,
-
-            'average_lunch_dreams': '{:.2f}'.format(sum_lunch_dreams / float(denom)),
-            'average_dinner_dreams': '{:.2f}'.format(sum_dinner_dreams / float(denom)),
-            'average_lunch_dreamers': '{:.2f}'.format(sum_lunch_dreamers / float(denom)),
-            'average_dinner_dreamers': '{:.2f}'.format(sum_dinner_dreamers / float(denom)),
-            'average_lunch_customers': '{:.2f}'.format(sum_lunch_customers / float(denom)),
-            'average_dinner_customers': '{:.2f}'.format(sum_dinner_customers / float(denom)),
-
-            'average_dream_achievement_rate': "{:.2f}".format(
-                sum(report.get_achievement_rate() for report in month_reports) / float(denom)),
-            'num_reports': len(month_reports),
-            'month_string': datetime.datetime.strptime('2018-{:02d}-01'.format(month), '%Y-%m-%d').strftime('%B'),
-        }
-
-    def _make_weekly_dict(self, reports_this_year, lunch_or_dinner):
-        '''
-        Returns a dict with keys = "Tuesday", ..., "Saturday"
-                            vals = [(date, customer count), ...] pairs
-        i.e. dict['Tuesday'] = [(Jan 01, 98), (Jan 08, 90), ...]
 
-        Guaranteed to be fully populated with every week up until today's date.
-        `lunch_or_dinner` must be 'lunch' or 'dinner'.
-        '''
-        assert lunch_or_dinner in {'lunch', 'dinner'}
-        open_days = {'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday'}
-        d = {day: [] for day in open_days}
-        # Go back in time until we see the first saturday in reverse order (i.e. a full complete week tuesday-saturday)
-        found_first_saturday = False
-        for report in sorted(reports_this_year, key=lambda x: x.date, reverse=True):
-            weekday = report.date.strftime("%A")
-            if not found_first_saturday and weekday != 'Saturday':
-                continue
-            found_first_saturday = True
-            if weekday in open_days:
-                # If we missed a week, add in a dummy '0' report
-                if len(d[weekday]) > 0:
-                    prev_date = d[weekday][-1][0]
-                    # Previously added date could be, e.g. 7/17/18 and current date = 7/10/18
-                    while (prev_date - report.date) > datetime.timedelta(weeks=1):
-                        d[weekday].append((prev_date - datetime.timedelta(weeks=1), 0))
-                        prev_date = d[weekday][-1][0]
-                if lunch_or_dinner == 'lunch':
-                    d[weekday].append((report.date, report.lunch_customers_today))
-                else:
-                    d[weekday].append((report.date, report.dinner_customers_today))
-        tuesday_len = len(d['Tuesday'])
-        for day in ['Wednesday', 'Thursday', 'Friday', 'Saturday']:
-            while len(d[day]) < tuesday_len:
-                d[day].append((datetime.datetime.now(), ""))
-        return d
+class StatsHandler(webapp2.RequestHandler):
+    '''
+    Handler to view statistics about the reports. GET only.
+    '''
 
     def get(self):
-        force_datetime = self.request.get_all('force_datetime')
-        this_datetime = datetime.datetime.now()
-        print('force_datetime: {}'.format(force_datetime))
-        if force_datetime is not None and len(force_datetime) > 0:
-            force_datetime = force_datetime[0]
-            if len(force_datetime) > 0:
-                date_fmt = '%Y-%m-%d'  # 2019-01-14 
-                force_datetime = datetime.datetime.strptime(force_datetime, date_fmt)
-        reports_this_year = get_reports_this_year(force_datetime)
-        this_year = this_datetime.year
-        this_month = this_datetime.month
-        january_1_this_year = datetime.datetime.strptime('01/01/{}'.format(this_year), '%m/%d/%Y')
-        december_31_this_year = datetime.datetime.strptime('12/31/{}'.format(this_year), '%m/%d/%Y')
-        reports_this_year = [report for report in Report.query(ndb.AND(
-            Report.date >= january_1_this_year,
-            Report.date <= december_31_this_year,
-        )) if report.is_finalized()]
-        #monthly_stats_list = [self._make_dict_for_month(month_num, reports_this_year) for month_num in range(this_month, 0, -1)]
-        monthly_stats_list = [{} for month_num in range(this_month, 0, -1)]
-        self._make_monthly_stats_list(monthly_stats_list, reports_this_year)
+        import rollups
+        import stats
+        force_datetime = self.request.get('force_datetime', '')
+        if force_datetime:
+            date_fmt = '%Y-%m-%d'  # 2019-01-14
+            this_datetime = datetime.datetime.strptime(force_datetime, date_fmt)
+        else:
+            this_datetime = datetime.datetime.now()
+        year = get_year_input(self, 'year')
+        if year is None or year == this_datetime.year:
+            year = this_datetime.year
+            num_months = this_datetime.month
+        else:
+            num_months = 12
+        month_rollups = rollups.get_rollups_for_years([year])[year]
+        monthly_stats_list = stats.format_monthly_stats([rollup.to_dict() for rollup in month_rollups[:num_months]])
+        totals = YearTotals.get_for_year(year)
         template_values = {}
         template_values['goals'] = get_goals()
+        template_values['year'] = year
+        # The goals are only for this year, other years just show their total
+        template_values['is_current_year'] = year == this_datetime.year
+        template_values['dreams_this_year'] = totals.dreams
         template_values['monthly_stats_list'] = monthly_stats_list
-        '''
-        weekly_lunch_stats_dict = self._make_weekly_dict(reports_this_year, 'lunch')
-        weekly_dinner_stats_dict = self._make_weekly_dict(reports_this_year, 'dinner')
-        weekly_lunch_stats_matrix = list(zip(
-            weekly_lunch_stats_dict['Tuesday'],
-            weekly_lunch_stats_dict['Wednesday'],
-            weekly_lunch_stats_dict['Thursday'],
-            weekly_lunch_stats_dict['Friday'],
-            weekly_lunch_stats_dict['Saturday'],
-        ))
-        weekly_dinner_stats_matrix = list(zip(
-            weekly_dinner_stats_dict['Tuesday'],
-            weekly_dinner_stats_dict['Wednesday'],
-            weekly_dinner_stats_dict['Thursday'],
-            weekly_dinner_stats_dict['Friday'],
-            weekly_dinner_stats_dict['Saturday'],
-        ))
-        for i, week in enumerate(weekly_lunch_stats_matrix):
-            print(week)
-            total_customers = sum(day[1] for day in week if type(day[1]) == int)
-            weekly_lunch_stats_matrix[i] = [x for x in week] + [total_customers]
-        for i, week in enumerate(weekly_dinner_stats_matrix):
-            print(week)
-            total_customers = sum(day[1] for day in week if type(day[1]) == int)
-            weekly_dinner_stats_matrix[i] = [x for x in week] + [total_customers]
-        template_values['weekly_lunch_stats_matrix'] = weekly_lunch_stats_matrix
-        template_values['weekly_dinner_stats_matrix'] = weekly_dinner_stats_matrix
-        '''
+        weekly_customer_tables = stats.get_weekly_customer_tables(YearIndex.get_for_year(year, totals))
+        template_values['weekly_lunch_stats_matrix'] = weekly_customer_tables['lunch']
+        template_values['weekly_dinner_stats_matrix'] = weekly_customer_tables['dinner']
         template = JINJA_ENVIRONMENT.get_template('stats.html')
         self.response.write(template.render(template_values))
 
 
+DEFAULT_COMPARISON_YEARS = 3
+MAX_COMPARISON_YEARS = 20
+
+
+class YearOverYearHandler(webapp2.RequestHandler):
+    '''
+    Compares the monthly stats of a range of years side by side. GET only.
+        GET with ?start_year=2016&end_year=2018, both optional (defaults to the last few years).
+    Only reads the month rollups, so it's at most 12 small entities per year, and never writes.
+    '''
+    def get(self):
+        import rollups
+        import stats
+        this_year = datetime.datetime.now().year
+        end_year = get_year_input(self, 'end_year') or this_year
+        start_year = get_year_input(self, 'start_year') or max(MIN_YEAR, end_year - DEFAULT_COMPARISON_YEARS + 1)
+        if start_year > end_year or end_year - start_year >= MAX_COMPARISON_YEARS:
+            self.abort(400, 'Pick at most {} years, oldest first'.format(MAX_COMPARISON_YEARS))
+        years = list(range(start_year, end_year + 1))
+        rollups_by_year = rollups.get_rollups_for_years(years)
+        year_stats_list = []
+        for year in years:
+            monthly_totals = [rollup.to_dict() for rollup in rollups_by_year[year]]
+            year_stats_list.append({
+                'year': year,
+                'monthly_stats_list': stats.format_monthly_stats(monthly_totals),
+                'year_stats': stats.format_year_stats(monthly_totals),
+            })
+        template_values = {}
+        template_values['start_year'] = start_year
+        template_values['end_year'] = end_year
+        template_values['year_stats_list'] = year_stats_list
+        template_values['month_strings'] = stats.MONTH_STRINGS
+        template = JINJA_ENVIRONMENT.get_template('yearoveryear.html')
+        self.response.write(template.render(template_values))
+
+
+DASHBOARD_FIELDS = ['dreams', 'dreamers', 'customers', 'report_count', 'yearly_dream_goal',
+                    'month_dreams', 'month_customers', 'month_report_count']
+
+
+@ndb.tasklet
+def get_location_summary_async(location_id, year, month):
+    '''
+    One location's numbers for the dashboard: its YearTotals, Goals and this month's rollup, fetched
+    by key from the location's namespace. Nothing is rebuilt here, so it's the same three gets no
+    matter how many reports the location has.
+    '''
+    import rollups
+    totals, goals, month_rollup = yield ndb.get_multi_async([
+        YearTotals.key_for_year(year, namespace=location_id),
+        ndb.Key(Goals, 'goals', namespace=location_id),
+        rollups.MonthRollup.key_for_month(year, month, namespace=location_id),
+    ])
+    summary = dict((field, 0) for field in DASHBOARD_FIELDS)
+    summary['last_finalized_date'] = None
+    if totals is not None:
+        summary['dreams'] = totals.dreams
+        summary['dreamers'] = totals.dreamers
+        summary['customers'] = totals.customers
+        summary['report_count'] = totals.report_count
+        summary['last_finalized_date'] = totals.last_finalized_date
+    if goals is not None:
+        summary['yearly_dream_goal'] = goals.yearly_dream_goal
+    if month_rollup is not None:
+        summary['month_dreams'] = month_rollup.total_lunch_dreams + month_rollup.total_dinner_dreams
+        summary['month_customers'] = month_rollup.total_lunch_customers + month_rollup.total_dinner_customers
+        summary['month_report_count'] = month_rollup.denom
+    raise ndb.Return(summary)
+
+
+def add_dashboard_percentages(summary):
+    summary['goal_percent'] = (round(100. * summary['dreams'] / summary['yearly_dream_goal'], 1)
+                               if summary['yearly_dream_goal'] else None)
+    summary['dreamer_customer_ratio'] = (round(100. * summary['dreamers'] / summary['customers'], 1)
+                                         if summary['customers'] else None)
+    return summary
+
+
+class DashboardHandler(webapp2.RequestHandler):
+    '''
+    This year's numbers of every location side by side, plus all of them together. GET only.
+    The locations are fetched concurrently (and ndb batches their gets), so adding a location adds
+    entities to the same round trip rather than another one.
+    '''
+    def get(self):
+        now = datetime.datetime.now()
+        all_locations = locations.get_locations()
+        futures = [get_location_summary_async(location_id, now.year, now.month) for location_id, _ in all_locations]
+        location_summaries = []
+        for (location_id, name), future in zip(all_locations, futures):
+            summary = add_dashboard_percentages(future.get_result())
+            summary['name'] = name
+            summary['url'] = locations.url('/', location_id)
+            location_summaries.append(summary)
+        overall = dict((field, sum(summary[field] for summary in location_summaries)) for field in DASHBOARD_FIELDS)
+        template_values = {}
+        template_values['year'] = now.year
+        template_values['month_string'] = now.strftime('%B')
+        template_values['location_summaries'] = location_summaries
+        template_values['overall'] = add_dashboard_percentages(overall)
+        template = JINJA_ENVIRONMENT.get_template('dashboard.html')
+        self.response.write(template.render(template_values))
+
+
+class AddLocationHandler(webapp2.RequestHandler):
+    '''
+    Registers a location, whose pages are then under /l/<location_id>/. POST with location_id and name.
+    '''
+    def post(self):
+        location_id = self.request.get('location_id', '').strip().lower()
+        try:
+            locations.add_location(location_id, self.request.get('name', '').strip())
+        except ValueError as e:
+            self.abort(400, detail=str(e))
+        self.redirect('/dashboard')
+
+
 class EditGoalHandler(webapp2.RequestHandler):
     '''
     Handler to edit the goals.
@@ -566,71 +764,158 @@ class EditGoalHandler(webapp2.RequestHandler):
         self.response.write(template.render(template_values))
 
     def post(self):
-        goals_obj = get_goals()
+        goals_obj = load_goals()
         yearly_dream_goal = get_integer_input(self.request, 'yearly_dream_goal', goals_obj.yearly_dream_goal)
         month_goal = self.request.get('month_goal', goals_obj.month_goal)
         year_goal = self.request.get('year_goal', goals_obj.year_goal)
         goals_obj.yearly_dream_goal = yearly_dream_goal
         goals_obj.month_goal = month_goal
         goals_obj.year_goal = year_goal
-        goals_obj.put()
-        self.redirect('/')
+        save_goals(goals_obj)
+        self.redirect(locations.url('/'))
 
 
 class DeleteReportHandler(webapp2.RequestHandler):
     def post(self, date_string):
         old_report_key = ndb.Key(Report, date_string)
-        if old_report_key.get() is not None:
-            old_report_key.delete()
-        self.redirect('/')
+        delete_report(old_report_key)
+        self.redirect(locations.url('/'))
+
+
+class RebuildTotalsHandler(webapp2.RequestHandler):
+    '''
+    Recomputes the YearTotals, month rollups and the yearly numbers stored on the reports from scratch,
+    i.e. after editing reports by hand in the datastore console.
+        GET this endpoint to get the rebuild form
+        POST here with year=2018 to rebuild one year, or with no year to rebuild every year that has reports.
+    '''
+    def get(self):
+        template = JINJA_ENVIRONMENT.get_template('rebuildtotals.html')
+        self.response.write(template.render({}))
+
+    def post(self):
+        year = get_integer_input(self.request, 'year')
+        if year is not None:
+            years = [year]
+        else:
+            years = sorted(set(report.date.year for report in Report.get_all_reports()))
+        rebuilt = []
+        for year in years:
+            rebuilt.append(YearTotals.rebuild(year))
+            update_year_derived_data_or_retry(year)
+        page_cache.invalidate_all()
+        template = JINJA_ENVIRONMENT.get_template('rebuildtotals.html')
+        self.response.write(template.render({'rebuilt': rebuilt}))
+
+
+MAX_DREAM_SCENARIOS = 100
+MAX_DREAM_GOAL = 1000000
+
+
+def get_dream_month(request, default_year):
+    '''
+    The (year, month) in `request`, the month being None if it's missing.
+    Raises ValueError with a message for the form if either is invalid.
+    '''
+    try:
+        year = get_integer_input(request, 'year') or default_year
+        month_num = get_integer_input(request, 'month')
+    except ValueError:
+        raise ValueError('The year and month have to be whole numbers')
+    if not MIN_YEAR <= year <= MAX_YEAR:
+        raise ValueError('The year has to be between {} and {}'.format(MIN_YEAR, MAX_YEAR))
+    if month_num is not None and not 1 <= month_num <= 12:
+        raise ValueError('The month has to be between 1 and 12')
+    return (year, month_num)
+
+
+def get_dream_scenarios(request):
+    '''
+    The goal scenarios in `request`: the i-th value of each of stats.DREAM_GOAL_KEYS makes up the i-th
+    scenario. Scenarios left completely blank are skipped. Raises ValueError with a message for the form
+    on anything else, e.g. a scenario that's only partly filled in.
+    '''
+    import stats
+    values = [request.get_all(key) for key in stats.DREAM_GOAL_KEYS]
+    num_scenarios = len(values[0])
+    if any(len(key_values) != num_scenarios for key_values in values):
+        raise ValueError('Every scenario needs all of ' + ', '.join(stats.DREAM_GOAL_LABELS[key] for key in stats.DREAM_GOAL_KEYS))
+    scenarios = []
+    for i in range(num_scenarios):
+        scenario_values = [key_values[i].strip() for key_values in values]
+        if not any(scenario_values):
+            continue
+        scenario = {}
+        for key, value in zip(stats.DREAM_GOAL_KEYS, scenario_values):
+            label = stats.DREAM_GOAL_LABELS[key]
+            if not value:
+                raise ValueError('Scenario {} is missing {}'.format(i + 1, label))
+            try:
+                scenario[key] = int(value)
+            except ValueError:
+                raise ValueError('Scenario {}: {} has to be a whole number'.format(i + 1, label))
+            if not 0 <= scenario[key] <= MAX_DREAM_GOAL:
+                raise ValueError('Scenario {}: {} has to be between 0 and {}'.format(i + 1, label, MAX_DREAM_GOAL))
+        scenarios.append(scenario)
+    if len(scenarios) > MAX_DREAM_SCENARIOS:
+        raise ValueError('At most {} scenarios at a time'.format(MAX_DREAM_SCENARIOS))
+    return scenarios
 
 
 class DreamCalculatorHandler(webapp2.RequestHandler):
     '''
-    Handler to . TODO: write this
-        GET here to ...
-        POST here to ...
+    Compares a month's actual numbers against per-day goals, for any number of goal scenarios at once.
+        GET with no scenarios for the form.
+        GET with year (optional, defaults to this year), month and the goals of each scenario, i.e.
+            ?month=6&lunch_customers_today=60&lunch_dreams=30&...&lunch_customers_today=70&lunch_dreams=35&...
+            for a comparison table. Add format=json for the same thing as JSON.
+        Invalid input shows the form again with what was entered and an error (a 400 for JSON).
     '''
     def get(self):
+        import stats
         request = self.request
-        # If we have any of the proper fields (dream/lunch_*s), display them and the achievement dict, along with a back button.
-        # Otherwise, display the static page which will post to this endpoint indicating which month the user wants and the appropriate goals.
-        template_values = {}
+        template_values = {'goal_fields': [(key, stats.DREAM_GOAL_LABELS[key]) for key in stats.DREAM_GOAL_KEYS]}
         this_datetime = datetime.datetime.now()
-        if (
-            request.get('month', None) is not None and
-            request.get('lunch_customers_today', None) is not None and
-            request.get('lunch_dreams', None) is not None and
-            request.get('lunch_dreamers', None) is not None and
-            request.get('dinner_customers_today', None) is not None and
-            request.get('dinner_dreams', None) is not None and
-            request.get('dinner_dreamers', None) is not None
-        ):
-            month_num = int(request.get('month', None))
-            month_datetime = datetime.datetime.strptime('{:02d}/01/{:04d}'.format(month_num, this_datetime.year), '%m/%d/%Y')
-            template_values['month_display'] = month_datetime.strftime('%B %Y')
-            reports_this_month = get_reports_this_month(month_num)
-            goal_dict = {
-                'lunch_customers_today': int(request.get('lunch_customers_today')),
-                'lunch_dreams': int(request.get('lunch_dreams')),
-                'lunch_dreamers': int(request.get('lunch_dreamers')),
-                'dinner_customers_today': int(request.get('dinner_customers_today')),
-                'dinner_dreams': int(request.get('dinner_dreams')),
-                'dinner_dreamers': int(request.get('dinner_dreamers')),
-            }
-            (actual_dict, expected_dict) = calculate_dream_dicts(reports_this_month, goal_dict)
-
-            for key in actual_dict:
-                template_values['goal_{}'.format(key)] = goal_dict[key]
-                template_values['actual_{}'.format(key)] = actual_dict[key]
-                template_values['expected_{}'.format(key)] = expected_dict[key]
-                if expected_dict[key] != 0:
-                    template_values['percent_{}'.format(key)] = "{:.2f}".format(100 * float(actual_dict[key]) / expected_dict[key])
-                else:
-                    template_values['percent_{}'.format(key)] = "100"
+        year, month_num, scenarios = this_datetime.year, None, []
+        try:
+            year, month_num = get_dream_month(request, this_datetime.year)
+            scenarios = get_dream_scenarios(request)
+        except ValueError as e:
+            if request.get('format') == 'json':
+                self.abort(400, str(e))
+            template_values['error'] = str(e)
+
+        if 'error' not in template_values and month_num is not None and scenarios:
+            # Loaded once, however many scenarios there are
+            reports_this_month = get_reports_this_month(month_num, year)
+            actual_dict, results = stats.evaluate_dream_scenarios(reports_this_month, scenarios)
+            if request.get('format') == 'json':
+                self.response.headers['Content-Type'] = 'application/json'
+                self.response.write(json.dumps({
+                    'year': year,
+                    'month': month_num,
+                    'actual': actual_dict,
+                    'scenarios': [{
+                        'goals': result['goals'],
+                        'expected': result['expected'],
+                        'percent': dict((key, round(percent, 2)) for key, percent in result['percent'].items()),
+                    } for result in results],
+                }, sort_keys=True))
+                return
+            template_values['month_display'] = datetime.datetime(year, month_num, 1).strftime('%B %Y')
+            template_values['actual'] = actual_dict
+            template_values['results'] = results
         else:
-            # First pass of this page - which month is the user requesting?
-            template_values['max_month'] = this_datetime.month
+            # First pass of this page - which month is the user requesting? After an error, the same
+            # form again with what was entered.
+            entered = dict((key, request.get_all(key)) for key in stats.DREAM_GOAL_KEYS)
+            num_scenarios = min(max([3] + [len(values) for values in entered.values()]), MAX_DREAM_SCENARIOS)
+            template_values['year'] = year
+            template_values['month'] = month_num
+            template_values['max_month'] = this_datetime.month if year == this_datetime.year else 12
+            template_values['num_scenarios'] = num_scenarios
+            template_values['entered'] = dict(
+                (key, (values + [''] * num_scenarios)[:num_scenarios]) for key, values in entered.items())
 
         template = JINJA_ENVIRONMENT.get_template('dreamcalculator.html')
         self.response.write(template.render(template_values))
@@ -640,30 +925,147 @@ class MainHandler(webapp2.RequestHandler):
     '''
     Main page: Links to creating a report or viewing all reports, or view most recent report?
     '''
+    def get(self):
+        this_year = datetime.datetime.now().year
+        # The recent reports can reach back into last year, so both years' stamps go into the cache key
+        futures = [
+            get_goals_async(),
+            YearTotals.get_for_year_async(this_year),
+            YearTotals.get_for_year_async(this_year - 1),
+        ]
+        goals, totals, last_year_totals = [future.get_result() for future in futures]
+        page_key = page_cache.index_page_key(goals, [totals, last_year_totals])
+        html = page_cache.get_page(page_key)
+        if html is None:
+            template_values = {}
+            # list of most recent reports
+            # total number of dreams
+            # average number of dreams per diem
+            template_values['goals'] = goals
+            recent_reports = get_recent_reports(20)
+            # ignore incomplete reports
+            sorted_reports = [report for report in recent_reports if report.is_finalized()]
+            template_values['reports'] = sorted_reports
+            template = JINJA_ENVIRONMENT.get_template('index.html')
+            html = template.render(template_values)
+            # The reports query can still be missing the latest report, don't keep a page without it
+            last_finalized_date = totals.last_finalized_date or last_year_totals.last_finalized_date
+            if last_finalized_date is None or (sorted_reports and sorted_reports[0].date == last_finalized_date):
+                page_cache.set_page(page_key, html)
+        self.response.write(html)
+
+
+class ExportReportsHandler(webapp2.RequestHandler):
+    '''
+    Downloads every report. GET with format=csv (default) or format=jsonl.
+    '''
+    def get(self):
+        import bulk
+        export_format = self.request.get('format', 'csv')
+        if export_format == 'csv':
+            self.response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+            body = bulk.export_csv(bulk.iter_reports())
+        elif export_format == 'jsonl':
+            self.response.headers['Content-Type'] = 'application/x-ndjson; charset=utf-8'
+            body = bulk.export_jsonl(bulk.iter_reports())
+        else:
+            self.abort(400, detail='format must be csv or jsonl')
+        self.response.headers['Content-Disposition'] = 'attachment; filename=reports.{}'.format(export_format)
+        self.response.app_iter = body
+
+
+class ImportReportsHandler(webapp2.RequestHandler):
+    '''
+    Uploads reports from an export (existing reports with the same dates are overwritten).
+        GET this endpoint to get the upload form
+        POST a CSV or JSON lines file as `file`
+    '''
+    def get(self):
+        template = JINJA_ENVIRONMENT.get_template('importreports.html')
+        self.response.write(template.render({}))
+
+    def post(self):
+        import bulk
+        upload = self.request.POST.get('file')
+        if upload is None or not hasattr(upload, 'file'):
+            self.abort(400, detail='No file uploaded')
+        if upload.filename.endswith('.jsonl') or self.request.get('format') == 'jsonl':
+            rows, decode_row = bulk.iter_jsonl_rows(upload.file), bulk.decode_jsonl_row
+        else:
+            rows, decode_row = bulk.iter_csv_rows(upload.file), bulk.decode_csv_row
+        num_saved, errors = bulk.import_rows(rows, decode_row, get_goals())
+        page_cache.invalidate_all()
+        template = JINJA_ENVIRONMENT.get_template('importreports.html')
+        self.response.write(template.render({'num_saved': num_saved, 'errors': errors}))
+
+
+class ConsistencyCheckHandler(webapp2.RequestHandler):
+    '''
+    Checks the YearTotals, month rollups and stored yearly numbers against the reports.
+        GET to check and see the summary (nothing is written)
+        POST to repair whatever is off, in a task since it reads every report
+    '''
+    def get(self):
+        import consistency
+        summary = consistency.check()
+        template = JINJA_ENVIRONMENT.get_template('consistency.html')
+        self.response.write(template.render({'summary': summary.as_text()}))
+
+    def post(self):
+        import consistency
+        from google.appengine.ext import deferred
+        deferred.defer(consistency.repair_task, namespace_manager.get_namespace())
+        template = JINJA_ENVIRONMENT.get_template('consistency.html')
+        self.response.write(template.render({'repair_started': True}))
+
+
+class WarmupHandler(webapp2.RequestHandler):
+    '''
+    App Engine's warmup request (app.yaml has `inbound_services: warmup`): loads what the first real
+    request would otherwise have to, see warmup.py. GET only.
+    '''
+    def get(self):
+        import warmup
+        timings = warmup.prime_caches()
+        self.response.headers['Content-Type'] = 'text/plain'
+        self.response.write(warmup.format_timings(timings))
+
+
+class DebugPerfHandler(webapp2.RequestHandler):
+    '''
+    Recent request timings per route, from the perf middleware's ring buffers. GET only.
+    '''
     def get(self):
         template_values = {}
-        # list of most recent reports
-        # total number of dreams
-        # average number of dreams per diem
-        template_values['goals'] = get_goals()
-        recent_reports = [x for x in Report.query().order(-Report.date).fetch(limit=20)]
-        sorted_reports = sorted(recent_reports, key=lambda x: x.date, reverse=True)
-        # ignore incomplete reports
-        sorted_reports = [report for report in sorted_reports if report.is_finalized()]
-        template_values['reports'] = sorted_reports
-        template = JINJA_ENVIRONMENT.get_template('index.html')
+        template_values['route_summaries'] = perf.get_route_summaries()
+        template_values['ring_buffer_size'] = perf.RING_BUFFER_SIZE
+        template = JINJA_ENVIRONMENT.get_template('debugperf.html')
         self.response.write(template.render(template_values))
 
 
-app = webapp2.WSGIApplication([
-    (r'/reports', MainHandler),
+app = locations.LocationMiddleware(perf.PerfMiddleware(webapp2.WSGIApplication([
+    (r'/reports', ViewAllReportsHandler),
+    (r'/api/reports', ReportListApiHandler),
+    (r'/api/report/(\d\d\d\d-\d\d-\d\d)', ReportApiHandler),
+    (r'/api/stats', StatsApiHandler),
+    (r'/api/goals', GoalsApiHandler),
     (r'/report/(\d\d\d\d-\d\d-\d\d)', ViewReportHandler),
     (r'/createreport', CreateReportHandler),
     (r'/previewreport', PreviewReportHandler),
+    (r'/api/preview', PreviewApiHandler),
     (r'/stats', StatsHandler),
+    (r'/stats/years', YearOverYearHandler),
     (r'/editgoals', EditGoalHandler),
     (r'/dreamcalculator', DreamCalculatorHandler),
     (r'/deletereport/(\d\d\d\d-\d\d-\d\d)', DeleteReportHandler),
+    (r'/rebuildtotals', RebuildTotalsHandler),
+    (r'/admin/export', ExportReportsHandler),
+    (r'/admin/import', ImportReportsHandler),
+    (r'/admin/consistency', ConsistencyCheckHandler),
+    (r'/debug/perf', DebugPerfHandler),
+    (r'/_ah/warmup', WarmupHandler),
+    (r'/dashboard', DashboardHandler),
+    (r'/admin/locations', AddLocationHandler),
     (r'/', MainHandler),
-], debug=True)
+], debug=True)))
 
@@ -0,0 +1,108 @@
+'''
+Cache for rendered HTML pages.
+
+Pages are stored in memcache when it's available (i.e. on App Engine), otherwise in a small in-process
+LRU. A page's key is built from the stamps of the data it shows (the Goals version and YearTotals.stamp
+of the years it covers), read before rendering, so a write moves every page it affects to a new key. A
+render that started before a write can only ever be stored under the old key.
+
+The stamps are per year, so a write to one report moves the pages of every report of that year, not
+just the ones dated on or after it (whose yearly numbers actually changed). That's deliberate: the
+stamp is one small get that's needed anyway, while knowing whether anything up to a given date changed
+would take a per-date version that every write has to update. The earlier pages just get rendered once
+more.
+
+Every key also carries the app version and a generation stamp, so a deploy or `invalidate_all` makes
+every cached page unreachable without having to know which pages exist.
+'''
+import collections
+import os
+import threading
+
+try:
+    from google.appengine.api import memcache
+except ImportError:
+    memcache = None
+
+
+KEY_PREFIX = 'page_cache'
+GENERATION_KEY = KEY_PREFIX + ':generation'
+# Cached pages are exact, this only bounds how long an orphaned page sits in memcache
+PAGE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+
+class LRUCache(object):
+    '''
+    Thread-safe least-recently-used cache with the subset of the memcache interface used here.
+    '''
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            value = self._items.pop(key)
+            self._items[key] = value
+            return value
+
+    def set(self, key, value, time=0):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return True
+
+    def incr(self, key, initial_value=0):
+        with self._lock:
+            value = self._items.pop(key, initial_value) + 1
+            self._items[key] = value
+            return value
+
+
+_local_cache = LRUCache()
+
+
+def _get_backend():
+    if memcache is not None:
+        return memcache
+    return _local_cache
+
+
+def _get_generation():
+    generation = _get_backend().get(GENERATION_KEY)
+    return generation if generation is not None else 0
+
+
+def _make_key(page_key):
+    return '{}:{}:{}:{}'.format(KEY_PREFIX, os.environ.get('CURRENT_VERSION_ID', ''), _get_generation(), page_key)
+
+
+def report_page_key(date_string, goals, totals):
+    '''
+    Page key for /report/<date_string>, given the Goals and the YearTotals of the report's year. Changes
+    with any write to that year, including writes dated after the report (see the module docstring).
+    '''
+    return 'report:{}:{}:{}'.format(date_string, goals.version, totals.stamp)
+
+
+def index_page_key(goals, year_totals):
+    ''' Page key for the index page, given the Goals and the YearTotals of every year it shows reports from '''
+    return 'index:{}:{}'.format(goals.version, ':'.join(
+        '{}.{}'.format(totals.key.id(), totals.stamp) for totals in year_totals))
+
+
+def get_page(page_key):
+    return _get_backend().get(_make_key(page_key))
+
+
+def set_page(page_key, html):
+    _get_backend().set(_make_key(page_key), html, time=PAGE_TTL_SECONDS)
+
+
+def invalidate_all():
+    ''' Makes every cached page stale, i.e. after repairs that don't go through the stamps '''
+    _get_backend().incr(GENERATION_KEY, initial_value=0)
@@ -0,0 +1,184 @@
+'''
+Per-request performance instrumentation.
+
+`PerfMiddleware` wraps the WSGI app and, for every request, counts the datastore RPCs (gets, queries
+and the entities they return) and the time spent in them and in Jinja rendering. The numbers go out
+as a `Server-Timing` header and a structured log line, and the total time of the last requests of
+each route is kept in a bounded ring buffer for /debug/perf. Requests are grouped by the webapp2 route
+they matched, so there's one ring buffer per route in the app (plus one for paths no route matched)
+however many different URLs get requested.
+'''
+import collections
+import json
+import logging
+import threading
+import time
+
+import jinja2
+import webapp2
+from google.appengine.api import apiproxy_stub_map
+
+
+# How many recent requests per route /debug/perf computes its percentiles over
+RING_BUFFER_SIZE = 500
+# Route name of the requests that didn't match any route (404s)
+UNMATCHED_ROUTE = '<no route>'
+ROUTE_ENVIRON_KEY = 'perf.route'
+
+_local = threading.local()
+_recent_lock = threading.Lock()
+_recent_requests = {}
+
+
+class RequestStats(object):
+    def __init__(self):
+        self.start = time.time()
+        self.gets = 0
+        self.queries = 0
+        self.entities = 0
+        # Summed over RPCs, so overlapping async RPCs can add up to more than the wall time
+        self.datastore_ms = 0.
+        self.render_ms = 0.
+        self.total_ms = None
+        self._rpc_starts = {}
+
+    def finish(self):
+        self.total_ms = (time.time() - self.start) * 1000
+        return self
+
+    def as_server_timing(self):
+        return 'datastore;dur={:.1f};desc="{} gets, {} queries, {} entities", render;dur={:.1f}, total;dur={:.1f}'.format(
+            self.datastore_ms, self.gets, self.queries, self.entities, self.render_ms, self.total_ms)
+
+    def as_dict(self):
+        return {
+            'gets': self.gets,
+            'queries': self.queries,
+            'entities': self.entities,
+            'datastore_ms': round(self.datastore_ms, 1),
+            'render_ms': round(self.render_ms, 1),
+            'total_ms': round(self.total_ms, 1) if self.total_ms is not None else None,
+        }
+
+
+def get_current_stats():
+    ''' Stats of the request being handled on this thread, or None outside of a request '''
+    return getattr(_local, 'stats', None)
+
+
+def _datastore_pre_call(service, call, request, response):
+    stats = get_current_stats()
+    if stats is not None:
+        stats._rpc_starts[id(request)] = time.time()
+
+
+def _datastore_post_call(service, call, request, response):
+    stats = get_current_stats()
+    if stats is None:
+        return
+    start = stats._rpc_starts.pop(id(request), None)
+    if start is not None:
+        stats.datastore_ms += (time.time() - start) * 1000
+    if call == 'Get':
+        stats.gets += 1
+        stats.entities += sum(1 for entity in response.entity_list() if entity.has_entity())
+    elif call in ('RunQuery', 'Next'):
+        if call == 'RunQuery':
+            stats.queries += 1
+        stats.entities += response.result_size()
+
+
+def install_datastore_hooks():
+    ''' Safe to call more than once, the hooks are registered by name '''
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('perf_datastore', _datastore_pre_call, 'datastore_v3')
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('perf_datastore', _datastore_post_call, 'datastore_v3')
+
+
+class TimedTemplate(jinja2.Template):
+    '''
+    Template class that adds its render time to the current request's stats.
+    Use it with `environment.template_class = TimedTemplate`.
+    '''
+    def render(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return super(TimedTemplate, self).render(*args, **kwargs)
+        finally:
+            stats = get_current_stats()
+            if stats is not None:
+                stats.render_ms += (time.time() - start) * 1000
+
+
+def _route_recording_matcher(router, request):
+    ''' webapp2 route matcher that leaves the template of the matched route in the environ for `PerfMiddleware` '''
+    match = webapp2.Router.default_matcher(router, request)
+    request.environ[ROUTE_ENVIRON_KEY] = match[0].template
+    return match
+
+
+def _record(route, stats):
+    with _recent_lock:
+        if route not in _recent_requests:
+            _recent_requests[route] = collections.deque(maxlen=RING_BUFFER_SIZE)
+        _recent_requests[route].append(stats.as_dict())
+
+
+def _percentile(sorted_values, percent):
+    index = int(round(percent / 100. * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+
+def get_route_summaries():
+    ''' Per-route percentiles over the requests in the ring buffers, sorted by route '''
+    with _recent_lock:
+        recent_requests = dict((route, list(requests)) for route, requests in _recent_requests.items())
+    summaries = []
+    for route in sorted(recent_requests):
+        requests = recent_requests[route]
+        total_ms = sorted(request['total_ms'] for request in requests)
+        summaries.append({
+            'route': route,
+            'count': len(requests),
+            'p50_ms': _percentile(total_ms, 50),
+            'p90_ms': _percentile(total_ms, 90),
+            'p99_ms': _percentile(total_ms, 99),
+            'max_ms': total_ms[-1],
+            'average_rpcs': sum(request['gets'] + request['queries'] for request in requests) / float(len(requests)),
+            'average_entities': sum(request['entities'] for request in requests) / float(len(requests)),
+            'average_datastore_ms': sum(request['datastore_ms'] for request in requests) / float(len(requests)),
+            'average_render_ms': sum(request['render_ms'] for request in requests) / float(len(requests)),
+        })
+    return summaries
+
+
+class PerfMiddleware(object):
+    '''
+    WSGI middleware that measures every request to `app`, a webapp2.WSGIApplication. The stats of a
+    request are also left in `environ['perf.stats']` for whoever called the app.
+    '''
+    def __init__(self, app):
+        self.app = app
+        app.router.set_matcher(_route_recording_matcher)
+        install_datastore_hooks()
+
+    def __call__(self, environ, start_response):
+        stats = RequestStats()
+        environ['perf.stats'] = stats
+        _local.stats = stats
+
+        def timed_start_response(status, headers, exc_info=None):
+            stats.finish()
+            headers = list(headers) + [('Server-Timing', stats.as_server_timing())]
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.app(environ, timed_start_response)
+        finally:
+            _local.stats = None
+            if stats.total_ms is None:
+                stats.finish()
+            route = environ.get(ROUTE_ENVIRON_KEY, UNMATCHED_ROUTE)
+            _record(route, stats)
+            log_line = stats.as_dict()
+            log_line['route'] = route
+            logging.info('perf %s', json.dumps(log_line, sort_keys=True))
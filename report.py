@@ -1,5 +1,13 @@
+from google.appengine.api import namespace_manager
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred
 from google.appengine.ext import ndb
+import bisect
 import datetime
+import logging
+import threading
+
+import report_fields
 
 
 class Report(ndb.Model):
@@ -52,42 +60,46 @@ class Report(ndb.Model):
     money_off_by = ndb.IntegerProperty()
     positive_cycle = ndb.IntegerProperty()
 
-    # hack for optimization. computes all stats based on the specificed list of Reports, but
-    # needs to be passed in beforehand. probably don't put() a Report with this attribute
-    # set, who knows what'll happen
-    report_list = None
+    """ Yearly numbers as of this report (DERIVED_FIELDS, along with daily_dream_goal) """
+    # Written by `save_report` and kept current by `update_year_derived_data`. None on reports saved before these existed.
+    customers_this_year = ndb.IntegerProperty()
+    dreams_this_year = ndb.IntegerProperty()
+    dreamers_this_year = ndb.IntegerProperty()
+    perfect_money_marathon = ndb.IntegerProperty()
+    achievement_rate = ndb.FloatProperty()
 
-    def get_previous_reports(self):
-        ''' Get all reports with dates less than the date of this report (in the same year), as well as this report '''
+    def get_date(self):
+        ''' Date of this report, or of "today" if it doesn't have one yet (reports are written after midnight) '''
         if self.date is None:
-            date = (datetime.datetime.now() - datetime.timedelta(hours=12)).date()
-        else:
-            date = self.date.date()
-        older_reports = [report for report in self.get_reports_for_year(date) if report.date.date() < date]
-        if self.is_finalized():
-            older_reports.append(self)
-        previous_reports = older_reports
-        return sorted(previous_reports, key=lambda x: x.date)
-
-    def get_perfect_money_marathon(self):
-        marathon = 0
-        # Go most recent to least recent
-        for report in reversed(self.get_previous_reports()):
-            if report.money_off_by == 0:
-                marathon += 1
-            else:
-                break
-        return marathon
+            return (datetime.datetime.now() - datetime.timedelta(hours=12)).date()
+        return self.date.date()
+
+    def get_previous_reports(self, context=None):
+        ''' Get all reports with dates less than the date of this report (in the same year), as well as this report '''
+        if context is None:
+            context = ReportContext.for_report(self)
+        return context.get_previous_reports(self)
+
+    def get_perfect_money_marathon(self, context=None):
+        if context is None:
+            context = ReportContext.for_report(self)
+        return context.get_year_to_date(self)['perfect_money_marathon']
 
-    def get_dreams_this_year(self):
-        return sum(report.get_dreams() for report in self.get_previous_reports())
+    def get_dreams_this_year(self, context=None):
+        if context is None:
+            context = ReportContext.for_report(self)
+        return context.get_year_to_date(self)['dreams_this_year']
 
 
-    def get_dreamers_this_year(self):
-        return sum(report.get_dreamers() for report in self.get_previous_reports())
+    def get_dreamers_this_year(self, context=None):
+        if context is None:
+            context = ReportContext.for_report(self)
+        return context.get_year_to_date(self)['dreamers_this_year']
 
-    def get_customers_this_year(self):
-        return sum(report.get_customers_today() for report in self.get_previous_reports())
+    def get_customers_this_year(self, context=None):
+        if context is None:
+            context = ReportContext.for_report(self)
+        return context.get_year_to_date(self)['customers_this_year']
 
     def is_finalized(self):
         ''' Returns True if all appropriate fields are populated. '''
@@ -111,28 +123,13 @@ class Report(ndb.Model):
         else:
             return None
 
-    def get_achievement_rate(self):
-        daily_dream_goal = self.get_daily_dream_goal()
-        if self.dreams is None:
-            return None
-        else:
-            if daily_dream_goal == 0:
-                return 100.
-        achievement_rate = (self.dreams / float(daily_dream_goal)) * 100
-        return achievement_rate
+    def get_achievement_rate(self, context=None):
+        return _get_achievement_rate(self, self.get_daily_dream_goal(context))
 
-    def get_daily_dream_goal(self):
-        from main import get_working_days_left_in_year
-        if self.date is None:
-            date = (datetime.datetime.now() - datetime.timedelta(hours=12)).date()
-        else:
-            date = self.date.date()
-        working_days_left_in_year = get_working_days_left_in_year(date)
-        if working_days_left_in_year == 0:
-            return 1
-        total_dreams_for_year = self.get_dreams_for_year2(date)
-        dreams_remaining = max(0, self.yearly_dream_goal - total_dreams_for_year)
-        return int(dreams_remaining / float(working_days_left_in_year))
+    def get_daily_dream_goal(self, context=None):
+        if context is None:
+            context = ReportContext.for_report(self)
+        return context.get_derived_fields(self)['daily_dream_goal']
 
     def get_customers_today(self):
         if self.lunch_customers_today is None or self.dinner_customers_today is None:
@@ -153,22 +150,39 @@ class Report(ndb.Model):
     def get_all_reports():
         return Report.query().order(-Report.date).fetch()
 
-    def get_reports_for_year2(self, datetime_obj):
-        ''' Gets all reports logged in the year of `datetime_obj` '''
-        if self.report_list is not None:
-            all_reports = self.report_list
-        else:
-            all_reports = Report.get_all_reports()
-        return [x for x in all_reports if x.date.date().year == datetime_obj.year and x.is_finalized()]
-
-    def get_dreams_for_year2(self, datetime_obj):
-        return sum(report.get_dreams() for report in self.get_reports_for_year2(datetime_obj))
+    @staticmethod
+    def query_for_year(year):
+        ''' Query for every report (finalized or not) dated in `year`, most recent first '''
+        return Report.query(ndb.AND(
+            Report.date >= datetime.datetime(year, 1, 1),
+            Report.date < datetime.datetime(year + 1, 1, 1),
+        )).order(-Report.date)
 
-    def get_dreamers_for_year2(self, datetime_obj):
-        return sum(report.get_dreamers() for report in self.get_reports_for_year2(datetime_obj))
+    @staticmethod
+    def fetch_rows_for_year(year):
+        ''' Every report dated in `year` as a ReportRow, most recent first. Only fetches the ReportRow fields. '''
+        return Report.fetch_rows_for_year_async(year).get_result()
 
-    def get_customers_for_year2(self, datetime_obj):
-        return sum(report.get_customers_today() for report in self.get_reports_for_year2(datetime_obj))
+    @staticmethod
+    @ndb.tasklet
+    def fetch_rows_for_year_async(year):
+        reports = yield Report.query_for_year(year).fetch_async(projection=REPORT_ROW_PROJECTION)
+        raise ndb.Return([ReportRow.from_report(report) for report in reports])
+
+    def get_dreams_for_year2(self, datetime_obj, context=None):
+        if context is not None and context.year == datetime_obj.year:
+            return context.dreams
+        return YearTotals.get_for_year(datetime_obj.year).dreams
+
+    def get_dreamers_for_year2(self, datetime_obj, context=None):
+        if context is not None and context.year == datetime_obj.year:
+            return context.dreamers
+        return YearTotals.get_for_year(datetime_obj.year).dreamers
+
+    def get_customers_for_year2(self, datetime_obj, context=None):
+        if context is not None and context.year == datetime_obj.year:
+            return context.customers
+        return YearTotals.get_for_year(datetime_obj.year).customers
 
     @staticmethod
     def get_reports_for_year(datetime_obj, report_list=None):
@@ -181,14 +195,20 @@ class Report(ndb.Model):
 
     @staticmethod
     def get_dreams_for_year(datetime_obj, report_list=None):
+        if report_list is None:
+            return YearTotals.get_for_year(datetime_obj.year).dreams
         return sum(report.get_dreams() for report in Report.get_reports_for_year(datetime_obj, report_list))
 
     @staticmethod
     def get_dreamers_for_year(datetime_obj, report_list=None):
+        if report_list is None:
+            return YearTotals.get_for_year(datetime_obj.year).dreamers
         return sum(report.get_dreamers() for report in Report.get_reports_for_year(datetime_obj, report_list))
 
     @staticmethod
     def get_customers_for_year(datetime_obj, report_list=None):
+        if report_list is None:
+            return YearTotals.get_for_year(datetime_obj.year).customers
         return sum(report.get_customers_today() for report in Report.get_reports_for_year(datetime_obj, report_list))
 
     @property
@@ -207,40 +227,769 @@ class Report(ndb.Model):
         else:
             return None
 
+    def get_stored_derived_fields(self):
+        ''' The same dict as ReportContext.get_derived_fields, from what was saved with the report. None if nothing was. '''
+        if self.dreams_this_year is None:
+            return None
+        return {field: getattr(self, field) for field in DERIVED_FIELDS}
+
+    def get_current_derived_fields(self, totals):
+        '''
+        The report's yearly numbers: the stored ones if `totals` (the YearTotals of its year) says they're
+        up to date, otherwise computed from the year's index.
+        '''
+        derived = self.get_stored_derived_fields()
+        if derived is None or not totals.derived_is_current:
+            year = self.get_date().year
+            derived = ReportContext(year, index=YearIndex.get_for_year(year, totals)).get_derived_fields(self)
+        return derived
+
+    def set_derived_fields(self, derived):
+        ''' Stores the `ReportContext.get_derived_fields` dict `derived`. Returns True if anything changed. '''
+        changed = False
+        for field in DERIVED_FIELDS:
+            if getattr(self, field) != derived[field]:
+                setattr(self, field, derived[field])
+                changed = True
+        return changed
+
     def update(self, old_report):
+        ''' Copies over every field `old_report` has a value for (see report_fields.merge_fields) '''
+        report_fields.merge_fields(self, old_report)
+
+
+# What ReportContext.get_derived_fields computes, which is also stored on each Report
+DERIVED_FIELDS = [
+    'customers_this_year',
+    'dreams_this_year',
+    'dreamers_this_year',
+    'perfect_money_marathon',
+    'daily_dream_goal',
+    'achievement_rate',
+]
+
+
+class ReportRow(object):
+    '''
+    Compact, read-only stand-in for a Report holding only the numbers that the aggregations read.
+
+    Has the same getters as Report for those numbers, so anything that only reads a report's numbers
+    (the year index, stats, the dream calculator) can be handed ReportRows instead of full entities.
+    '''
+    __slots__ = (
+        'date',
+        'lunch_customers_today',
+        'dinner_customers_today',
+        'lunch_dreams',
+        'dinner_dreams',
+        'lunch_dreamers',
+        'dinner_dreamers',
+        'dreams',
+        'money_off_by',
+        'yearly_dream_goal',
+    )
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ReportRow is read-only')
+
+    def __repr__(self):
+        return 'ReportRow({})'.format(', '.join(repr(getattr(self, name)) for name in self.__slots__))
+
+    @staticmethod
+    def from_report(report):
+        ''' Works for full Reports as well as ones from a REPORT_ROW_PROJECTION query '''
+        return ReportRow(*[getattr(report, name) for name in ReportRow.__slots__])
+
+    def get_date(self):
+        return self.date.date()
+
+    def get_customers_today(self):
+        if self.lunch_customers_today is None or self.dinner_customers_today is None:
+            return None
+        return self.lunch_customers_today + self.dinner_customers_today
+
+    def get_dreamers(self):
+        if self.lunch_dreamers is None or self.dinner_dreamers is None:
+            return None
+        return self.lunch_dreamers + self.dinner_dreamers
+
+    def get_dreams(self):
+        if self.lunch_dreams is None or self.dinner_dreams is None:
+            return None
+        return self.lunch_dreams + self.dinner_dreams
+
+    def is_finalized(self):
+        return (self.get_dreams() is not None and
+                self.get_customers_today() is not None and
+                self.get_dreamers() is not None)
+
+
+# The fields of a ReportRow, for projection queries
+REPORT_ROW_PROJECTION = [getattr(Report, name) for name in ReportRow.__slots__]
+
+
+# Everything the report lists (index page, /reports) show, for projection queries
+REPORT_LIST_PROJECTION = [
+    Report.date,
+    Report.lunch_customers_today,
+    Report.dinner_customers_today,
+    Report.lunch_dreams,
+    Report.dinner_dreams,
+    Report.lunch_dreamers,
+    Report.dinner_dreamers,
+    Report.end_time,
+    Report.end_time_dishwasher,
+    Report.end_time_host,
+    Report.end_time_kitchen,
+]
+
+
+def get_report_list_page(cursor_string=None, page_size=50):
+    '''
+    One page of reports, most recent first, with only the REPORT_LIST_PROJECTION fields filled in.
+    Returns (reports, cursor string for the next page or None if this is the last one).
+    '''
+    start_cursor = Cursor(urlsafe=cursor_string) if cursor_string else None
+    reports, next_cursor, more = Report.query().order(-Report.date).fetch_page(
+        page_size, start_cursor=start_cursor, projection=REPORT_LIST_PROJECTION)
+    return (reports, next_cursor.urlsafe() if more and next_cursor is not None else None)
+
+
+def get_recent_reports(count):
+    '''
+    The `count` most recent reports. Only their keys come from the query; the entities are fetched with
+    a get, which unlike a query always returns what was last saved. A report saved moments ago can
+    still be missing though.
+    '''
+    keys = Report.query().order(-Report.date).fetch(count, keys_only=True)
+    return [report for report in ndb.get_multi(keys) if report is not None]
+
+
+def _get_daily_dream_goal(report, date, total_dreams_for_year):
+    from main import get_working_days_left_in_year
+    working_days_left_in_year = get_working_days_left_in_year(date)
+    if working_days_left_in_year == 0:
+        return 1
+    dreams_remaining = max(0, report.yearly_dream_goal - total_dreams_for_year)
+    return int(dreams_remaining / float(working_days_left_in_year))
+
+
+def _get_achievement_rate(report, daily_dream_goal):
+    if report.dreams is None:
+        return None
+    else:
+        if daily_dream_goal == 0:
+            return 100.
+    achievement_rate = (report.dreams / float(daily_dream_goal)) * 100
+    return achievement_rate
+
+
+class YearIndex(object):
+    '''
+    The finalized reports of one year, boiled down to what the running numbers need: their dates in
+    order, prefix sums of dreams/dreamers/customers, where the money was last off and each report's
+    daily dream goal. Year-to-date totals and the perfect money marathon as of any date are then a
+    bisect away, and a saved report's daily dream goal is a dict lookup. The reports themselves
+    are kept as ReportRows, so month-by-month numbers can be computed from the index too.
+
+    One index per year (and location, i.e. namespace) is cached on the instance by `get_for_year`,
+    tagged with the YearTotals version it was built from. `save_report` and `delete_report` patch the cached index instead of dropping it.
+    '''
+    def __init__(self, year, version=None):
+        self.year = year
+        self.version = version
+        self.dates = []
+        # ReportRow of each report, in the same order as `dates`
+        self.rows = []
+        # dreams[i] is the sum over the first i reports, so these are one longer than `dates`
+        self.dreams = [0]
+        self.dreamers = [0]
+        self.customers = [0]
+        # last_money_miss[i] is the position of the latest report at or before i whose money was off, or -1
+        self.last_money_miss = []
+        # Each report's daily dream goal by date, from its yearly goal snapshot and the dreams up to and
+        # including it. Patched along with the prefix sums, so a write only recomputes the later days.
+        self.daily_dream_goals = {}
+        # Memo for things computed from the whole index (i.e. by stats). Not copied by `copy`, so a write
+        # that patches the cached index drops them along with the old index.
+        self.derived = {}
+
+    @staticmethod
+    def from_reports(year, reports, version=None):
+        index = YearIndex(year, version)
+        for report in sorted((x for x in reports if x.is_finalized()), key=lambda x: x.date):
+            index.dates.append(report.get_date())
+            index.rows.append(ReportRow.from_report(report))
+        index._recompute_from(0)
+        return index
+
+    @staticmethod
+    def get_for_year(year, totals=None):
+        ''' The index for `year`, from the instance cache if it's still current '''
+        return YearIndex.get_for_year_async(year, totals).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_for_year_async(year, totals=None):
+        cache_key = get_year_index_cache_key(year)
+        if totals is None:
+            totals = yield YearTotals.get_for_year_async(year)
+        index = _year_indexes.get(cache_key)
+        if index is not None and index.version == totals.version:
+            raise ndb.Return(index)
+        rows = yield Report.fetch_rows_for_year_async(year)
+        index = YearIndex.from_reports(year, rows, totals.version)
+        # The query is only eventually consistent, so don't cache an index that disagrees with the totals
+        if index.matches(totals):
+            with _year_indexes_lock:
+                cached_index = _year_indexes.get(cache_key)
+                if cached_index is None or cached_index.version < index.version:
+                    _year_indexes[cache_key] = index
+        raise ndb.Return(index)
+
+    @staticmethod
+    def apply_write(year, version, old_report=None, new_report=None):
+        ''' Patches the cached index for `year` after a write that moved its YearTotals to `version` '''
+        cache_key = get_year_index_cache_key(year)
+        with _year_indexes_lock:
+            index = _year_indexes.get(cache_key)
+            if index is None:
+                return
+            if index.version != version - 1:
+                # Missed a write somewhere, rebuild it the next time it's needed
+                del _year_indexes[cache_key]
+                return
+            # Copy so requests reading the current index never see it half-updated
+            index = index.copy()
+            if old_report is not None:
+                index.remove(old_report.get_date())
+            if new_report is not None:
+                index.insert(new_report)
+            index.version = version
+            _year_indexes[cache_key] = index
+
+    def copy(self):
+        index = YearIndex(self.year, self.version)
+        index.dates = list(self.dates)
+        index.rows = list(self.rows)
+        index.dreams = list(self.dreams)
+        index.dreamers = list(self.dreamers)
+        index.customers = list(self.customers)
+        index.last_money_miss = list(self.last_money_miss)
+        index.daily_dream_goals = dict(self.daily_dream_goals)
+        return index
+
+    def matches(self, totals):
+        return (len(self.dates) == totals.report_count and
+                self.dreams[-1] == totals.dreams and
+                self.dreamers[-1] == totals.dreamers and
+                self.customers[-1] == totals.customers)
+
+    def insert(self, report):
+        ''' Adds (or replaces) the entry for `report`'s date. Unfinalized reports just clear the date. '''
+        if not report.is_finalized():
+            self.remove(report.get_date())
+            return
+        date = report.get_date()
+        position = bisect.bisect_left(self.dates, date)
+        if position < len(self.dates) and self.dates[position] == date:
+            self.rows[position] = ReportRow.from_report(report)
+        else:
+            self.dates.insert(position, date)
+            self.rows.insert(position, ReportRow.from_report(report))
+        self._recompute_from(position)
+
+    def remove(self, date):
+        position = bisect.bisect_left(self.dates, date)
+        if position < len(self.dates) and self.dates[position] == date:
+            del self.dates[position]
+            del self.rows[position]
+            del self.daily_dream_goals[date]
+            self._recompute_from(position)
+
+    def _recompute_from(self, position):
+        ''' Rebuilds the prefix arrays from `position` on; everything before it is unchanged '''
+        del self.dreams[position + 1:]
+        del self.dreamers[position + 1:]
+        del self.customers[position + 1:]
+        del self.last_money_miss[position:]
+        for i in range(position, len(self.rows)):
+            row = self.rows[i]
+            self.dreams.append(self.dreams[-1] + row.get_dreams())
+            self.dreamers.append(self.dreamers[-1] + row.get_dreamers())
+            self.customers.append(self.customers[-1] + row.get_customers_today())
+            if row.money_off_by != 0:
+                self.last_money_miss.append(i)
+            else:
+                self.last_money_miss.append(self.last_money_miss[-1] if i > 0 else -1)
+            if row.yearly_dream_goal is not None:
+                self.daily_dream_goals[self.dates[i]] = _get_daily_dream_goal(row, self.dates[i], self.dreams[-1])
+            else:
+                self.daily_dream_goals[self.dates[i]] = None
+
+    def get_totals_before(self, date):
+        ''' (dreams, dreamers, customers) summed over the reports strictly before `date` '''
+        position = bisect.bisect_left(self.dates, date)
+        return (self.dreams[position], self.dreamers[position], self.customers[position])
+
+    def get_daily_dream_goal(self, report):
+        ''' `report`'s daily dream goal from the table, or None if the index doesn't have `report` as it is '''
+        date = report.get_date()
+        daily_dream_goal = self.daily_dream_goals.get(date)
+        if daily_dream_goal is None:
+            return None
+        row = self.rows[bisect.bisect_left(self.dates, date)]
+        if row.get_dreams() != report.get_dreams() or row.yearly_dream_goal != report.yearly_dream_goal:
+            return None
+        return daily_dream_goal
+
+    def get_marathon_before(self, date):
+        ''' Perfect money days in a row, counting back from the last report strictly before `date` '''
+        position = bisect.bisect_left(self.dates, date)
+        if position == 0:
+            return 0
+        return position - 1 - self.last_money_miss[position - 1]
+
+
+# (namespace, year) -> YearIndex
+_year_indexes = {}
+_year_indexes_lock = threading.Lock()
+
+
+def get_year_index_cache_key(year):
+    ''' Every location has its own reports in its own namespace, so its own indexes '''
+    return (namespace_manager.get_namespace(), year)
+
+
+class ReportContext(object):
+    '''
+    Everything about one year's reports that a request needs, loaded once.
+
+    Pass this to the Report getters (or use `get_derived_fields`) so that computing a report's
+    yearly numbers doesn't go back to the datastore for every single getter. The running numbers
+    come from the year's (cached) YearIndex; the Report entities themselves are only fetched if
+    something asks for `reports`.
+    '''
+    def __init__(self, year, reports=None, index=None):
+        self.year = year
+        if reports is None:
+            self._reports = None
+            self.index = index if index is not None else YearIndex.get_for_year(year)
+        else:
+            self._reports = sorted((report for report in reports if report.is_finalized()), key=lambda x: x.date)
+            self.index = YearIndex.from_reports(year, self._reports)
+
+    @staticmethod
+    def for_report(report):
+        return ReportContext.load_async(report.get_date().year).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def load_async(year):
+        ''' Start loading the context for `year`, i.e. alongside the other datastore calls of a request '''
+        index = yield YearIndex.get_for_year_async(year)
+        raise ndb.Return(ReportContext(year, index=index))
+
+    @property
+    def reports(self):
+        ''' The finalized reports of the year (as ReportRows, unless they were passed in), sorted by date '''
+        if self._reports is None:
+            reports = Report.fetch_rows_for_year(self.year)
+            self._reports = sorted((report for report in reports if report.is_finalized()), key=lambda x: x.date)
+        return self._reports
+
+    @property
+    def dreams(self):
+        return self.index.dreams[-1]
+
+    @property
+    def dreamers(self):
+        return self.index.dreamers[-1]
+
+    @property
+    def customers(self):
+        return self.index.customers[-1]
+
+    def get_previous_reports(self, report):
+        ''' Reports in this context dated before `report`, plus `report` itself if it's finalized. Sorted by date. '''
+        date = report.get_date()
+        previous_reports = [x for x in self.reports if x.date.date() < date]
+        if report.is_finalized():
+            previous_reports.append(report)
+        return previous_reports
+
+    def get_year_to_date(self, report):
+        ''' Year-to-date totals and perfect money marathon as of `report`, counting `report` if it's finalized '''
+        date = report.get_date()
+        dreams_this_year, dreamers_this_year, customers_this_year = self.index.get_totals_before(date)
+        perfect_money_marathon = self.index.get_marathon_before(date)
+        if report.is_finalized():
+            dreams_this_year += report.get_dreams()
+            dreamers_this_year += report.get_dreamers()
+            customers_this_year += report.get_customers_today()
+            perfect_money_marathon = perfect_money_marathon + 1 if report.money_off_by == 0 else 0
+        return {
+            'customers_this_year': customers_this_year,
+            'dreams_this_year': dreams_this_year,
+            'dreamers_this_year': dreamers_this_year,
+            'perfect_money_marathon': perfect_money_marathon,
+        }
+
+    def get_derived_fields(self, report):
+        '''
+        Everything about `report` that depends on the other reports of the year. The daily dream goal
+        is based on the dreams up to and including `report`, i.e. what it was on the day of the report.
+        '''
+        derived = self.get_year_to_date(report)
+        daily_dream_goal = self.index.get_daily_dream_goal(report)
+        if daily_dream_goal is None:
+            daily_dream_goal = _get_daily_dream_goal(report, report.get_date(), derived['dreams_this_year'])
+        derived['daily_dream_goal'] = daily_dream_goal
+        derived['achievement_rate'] = _get_achievement_rate(report, daily_dream_goal)
+        return derived
+
+
+class YearTotals(ndb.Model):
+    '''
+    Running totals over the finalized reports of a single year. Keyed by the year, i.e. "2018".
+
+    Kept up to date by `save_report` and `delete_report`, so anything that only needs the yearly
+    numbers can read this one entity instead of scanning every Report.
+    '''
+    dreams = ndb.IntegerProperty(default=0)
+    dreamers = ndb.IntegerProperty(default=0)
+    customers = ndb.IntegerProperty(default=0)
+    report_count = ndb.IntegerProperty(default=0)
+    last_finalized_date = ndb.DateTimeProperty()
+    # Bumped on every change, so per-instance caches of the year's data can tell if they're stale
+    version = ndb.IntegerProperty(default=0)
+    # The `version` that the yearly numbers stored on the reports and the month rollups were last brought
+    # up to date with, see `update_year_derived_data`. Behind `version` while that's still to be done.
+    derived_version = ndb.IntegerProperty(default=0)
+
+    @property
+    def derived_is_current(self):
+        return self.derived_version >= self.version
+
+    @property
+    def stamp(self):
+        '''
+        Changes whenever anything about the year that a page or API response shows does, for ETags and
+        cache keys. `derived_version` is written last, so the stamp moves again once the stored yearly
+        numbers and rollups have caught up with a write.
+        '''
+        return '{}.{}'.format(self.version, self.derived_version)
+
+    @staticmethod
+    def key_for_year(year, namespace=None):
+        ''' In the current namespace (location) unless `namespace` is given '''
+        return ndb.Key(YearTotals, str(year), namespace=namespace)
+
+    @staticmethod
+    def get_for_year(year):
         '''
-        StringProperties are not checked for None because they can be "" which we don't want (and it's also not None)
+        Totals for `year`. Built from scratch and saved the first time a year that has reports (saved
+        before YearTotals existed) is asked for. A year without any gets empty totals that aren't saved,
+        so looking one up (i.e. /report/1900-01-01) doesn't write anything.
         '''
-        if old_report.year_goal: self.year_goal = old_report.year_goal
-        if old_report.month_goal: self.month_goal = old_report.month_goal
-        if old_report.working_dishwasher: self.working_dishwasher = old_report.working_dishwasher
-        if old_report.working_host: self.working_host = old_report.working_host
-        if old_report.working_kitchen2: self.working_kitchen2 = old_report.working_kitchen2
-        if old_report.working_kitchen: self.working_kitchen = old_report.working_kitchen
-        if old_report.working_members: self.working_members = old_report.working_members
-        if old_report.supporting_members: self.supporting_members = old_report.supporting_members
-        if old_report.visiting_members: self.visiting_members = old_report.visiting_members
-        if old_report.misc_notes: self.misc_notes = old_report.misc_notes
-
-        if old_report.yearly_dream_goal is not None: self.yearly_dream_goal = old_report.yearly_dream_goal
-        if old_report.daily_dream_goal is not None: self.daily_dream_goal = old_report.daily_dream_goal
-        if old_report.date is not None: self.date = old_report.date
-        if old_report.customers_today is not None: self.customers_today = old_report.customers_today
-        if old_report.lunch_customers_today is not None: self.lunch_customers_today = old_report.lunch_customers_today
-        if old_report.dinner_customers_today is not None: self.dinner_customers_today = old_report.dinner_customers_today
-        if old_report.dreams is not None: self.dreams = old_report.dreams
-        if old_report.lunch_dreams is not None: self.lunch_dreams = old_report.lunch_dreams
-        if old_report.dinner_dreams is not None: self.dinner_dreams = old_report.dinner_dreams
-        if old_report.dreamers is not None: self.dreamers = old_report.dreamers
-        if old_report.lunch_dreamers is not None: self.lunch_dreamers = old_report.lunch_dreamers
-        if old_report.dinner_dreamers is not None: self.dinner_dreamers = old_report.dinner_dreamers
-        if old_report.end_time_dishwasher is not None: self.end_time_dishwasher = old_report.end_time_dishwasher
-        if old_report.end_time_host is not None: self.end_time_host = old_report.end_time_host
-        if old_report.end_time_kitchen is not None: self.end_time_kitchen = old_report.end_time_kitchen
-        if old_report.end_time is not None: self.end_time = old_report.end_time
-        if old_report.total_bowls is not None: self.total_bowls = old_report.total_bowls
-        if old_report.total_cups is not None: self.total_cups = old_report.total_cups
-        if old_report.chopsticks_missing is not None: self.chopsticks_missing = old_report.chopsticks_missing
-        if old_report.money_off_by is not None: self.money_off_by = old_report.money_off_by
-        if old_report.positive_cycle is not None: self.positive_cycle = old_report.positive_cycle
+        return YearTotals.get_for_year_async(year).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def get_for_year_async(year):
+        key = YearTotals.key_for_year(year)
+        totals = yield key.get_async()
+        if totals is None:
+            report_keys = yield Report.query_for_year(year).fetch_async(1, keys_only=True)
+            if report_keys:
+                totals = yield YearTotals.rebuild_async(year)
+            else:
+                totals = YearTotals(key=key)
+        raise ndb.Return(totals)
+
+    @staticmethod
+    def rebuild(year):
+        ''' Recomputes the totals for `year` from every Report in that year and saves them. '''
+        return YearTotals.rebuild_async(year).get_result()
+
+    @staticmethod
+    @ndb.tasklet
+    def rebuild_async(year):
+        old_totals, rows = yield YearTotals.key_for_year(year).get_async(), Report.fetch_rows_for_year_async(year)
+        totals = YearTotals(key=YearTotals.key_for_year(year))
+        if old_totals is not None:
+            totals.version = old_totals.version + 1
+            totals.derived_version = old_totals.derived_version
+        else:
+            # Nothing derived has been brought up to date with these yet
+            totals.version = 1
+        for report in rows:
+            totals.add(report)
+        yield totals.put_async()
+        raise ndb.Return(totals)
+
+    def add(self, report):
+        if not report.is_finalized():
+            return
+        self.dreams += report.get_dreams()
+        self.dreamers += report.get_dreamers()
+        self.customers += report.get_customers_today()
+        self.report_count += 1
+        if self.last_finalized_date is None or report.date > self.last_finalized_date:
+            self.last_finalized_date = report.date
+
+    def remove(self, report):
+        ''' Takes `report` back out of the totals. Returns True if `last_finalized_date` needs to be looked up again. '''
+        if not report.is_finalized():
+            return False
+        self.dreams -= report.get_dreams()
+        self.dreamers -= report.get_dreamers()
+        self.customers -= report.get_customers_today()
+        self.report_count -= 1
+        return self.last_finalized_date == report.date
+
+
+def _refresh_last_finalized_date(year, exclude_date):
+    '''
+    Finds the most recent finalized report in `year` after the previous latest one went away.
+    `exclude_date` is skipped since the query might not see the write/delete that got us here yet.
+    '''
+    last_finalized_date = None
+    for report in Report.fetch_rows_for_year(year):
+        if report.date != exclude_date and report.is_finalized():
+            last_finalized_date = report.date
+            break
+
+    @ndb.transactional
+    def txn():
+        totals = YearTotals.key_for_year(year).get()
+        if totals is not None and totals.last_finalized_date == exclude_date:
+            totals.last_finalized_date = last_finalized_date
+            totals.put()
+    txn()
+
+
+# Cross-group transactions can touch at most 25 entity groups
+DERIVED_FIELDS_BATCH_SIZE = 25
 
+
+def update_derived_fields(year, from_date=None):
+    '''
+    Recomputes the stored yearly numbers of the reports of `year` dated `from_date` or later (every
+    report of the year if it's None) and saves the ones that changed. Returns the number of reports
+    updated, or None if nothing could be done yet (see `update_year_derived_data`).
+    '''
+    totals = YearTotals.get_for_year(year)
+    index = YearIndex.get_for_year(year, totals)
+    if not index.matches(totals):
+        # The reports query hasn't caught up with a write yet; computing from it would store wrong numbers
+        logging.warning('Not updating the derived fields of %d yet, the reports query disagrees with the totals', year)
+        return None
+    context = ReportContext(year, index=index)
+    if from_date is None:
+        start = datetime.datetime(year, 1, 1)
+    else:
+        start = datetime.datetime.combine(from_date, datetime.time())
+    query = Report.query(ndb.AND(Report.date >= start, Report.date < datetime.datetime(year + 1, 1, 1)))
+    # The index has every finalized report even if the query doesn't see it yet
+    keys = set(query.iter(keys_only=True))
+    if from_date is not None:
+        # The report that was just written, which the query may not see and the index lacks if it's unfinalized
+        keys.add(ndb.Key(Report, from_date.strftime('%Y-%m-%d')))
+    keys.update(ndb.Key(Report, date.strftime('%Y-%m-%d')) for date in index.dates if date >= start.date())
+    return put_derived_fields(sorted(keys, key=lambda key: key.id()), context)
+
+
+def put_derived_fields(report_keys, context):
+    '''
+    Recomputes the stored yearly numbers of the reports at `report_keys` against `context` and saves
+    the ones that changed, a batch per transaction so a concurrent edit of one of them isn't overwritten.
+    Returns the number of reports updated.
+    '''
+    @ndb.transactional(xg=True)
+    def txn(batch_keys):
+        changed_reports = []
+        for report in ndb.get_multi(batch_keys):
+            if report is not None and report.set_derived_fields(context.get_derived_fields(report)):
+                changed_reports.append(report)
+        ndb.put_multi(changed_reports)
+        return len(changed_reports)
+
+    num_updated = 0
+    for i in range(0, len(report_keys), DERIVED_FIELDS_BATCH_SIZE):
+        num_updated += txn(report_keys[i:i + DERIVED_FIELDS_BATCH_SIZE])
+    return num_updated
+
+
+# How long to wait before retrying `update_year_derived_data` in a task
+DERIVED_DATA_RETRY_SECONDS = 10
+
+
+def update_year_derived_data(year, from_date=None):
+    '''
+    Brings what's derived from the reports of `year` up to date with its YearTotals version: the yearly
+    numbers stored on the reports dated `from_date` or later (every report if it's None) and the month
+    rollups. Then moves YearTotals.derived_version up to that version, so readers trust the stored
+    numbers again.
+
+    Returns False if the reports query hasn't caught up with the latest write yet. The year then stays
+    marked as behind, so readers recompute the numbers, and this has to be retried.
+    '''
+    totals = YearTotals.get_for_year(year)
+    if totals.derived_is_current:
+        return True
+    if totals.derived_version != totals.version - 1:
+        # More than the latest write is still to be done, and the earlier ones may be for earlier dates
+        from_date = None
+    if update_derived_fields(year, from_date) is None:
+        return False
+    from rollups import update_rollups
+    if not update_rollups(year):
+        return False
+    _set_derived_version(year, totals.version)
+    return True
+
+
+def _set_derived_version(year, version):
+    @ndb.transactional
+    def txn():
+        totals = YearTotals.key_for_year(year).get()
+        if totals is not None and totals.derived_version < version <= totals.version:
+            totals.derived_version = version
+            totals.put()
+    txn()
+
+
+def _update_year_derived_data_task(namespace, year):
+    ''' Runs as a deferred task, which is retried until it goes through '''
+    namespace_manager.set_namespace(namespace)
+    if not update_year_derived_data(year):
+        raise deferred.SingularTaskFailure()
+
+
+def update_year_derived_data_or_retry(year, from_date=None):
+    ''' `update_year_derived_data`, moved to a task that keeps retrying if it can't be done right away '''
+    try:
+        done = update_year_derived_data(year, from_date)
+    except Exception:
+        logging.exception('Updating what is derived from the reports of %d failed, retrying in a task', year)
+        done = False
+    if not done:
+        deferred.defer(_update_year_derived_data_task, namespace_manager.get_namespace(), year,
+                       _countdown=DERIVED_DATA_RETRY_SECONDS)
+
+
+def save_report(report):
+    '''
+    Puts `report`, replacing whatever was saved for that date, and updates its YearTotals in the same
+    transaction. The report is saved with its yearly numbers as a first guess (the index they come from
+    isn't checked against the totals), then they and those of the later reports of the year, whose
+    numbers include it, are recomputed afterwards along with the year's month rollups.
+    '''
+    year = report.date.year
+    # Make sure the totals exist before the transaction, building them needs a (non-ancestor) query
+    totals = YearTotals.get_for_year(year)
+    context = ReportContext(year, index=YearIndex.get_for_year(year, totals))
+    report.set_derived_fields(context.get_derived_fields(report))
+
+    @ndb.transactional(xg=True)
+    def txn():
+        totals = YearTotals.key_for_year(year).get() or YearTotals(key=YearTotals.key_for_year(year))
+        old_report = report.key.get()
+        needs_refresh = old_report is not None and totals.remove(old_report)
+        totals.add(report)
+        totals.version += 1
+        ndb.put_multi([report, totals])
+        return (old_report, totals.version, needs_refresh and not report.is_finalized())
+
+    old_report, version, needs_refresh = txn()
+    YearIndex.apply_write(year, version, old_report=old_report, new_report=report)
+    if needs_refresh:
+        _refresh_last_finalized_date(year, report.date)
+    update_year_derived_data_or_retry(year, report.get_date())
+
+
+def delete_report(report_key):
+    '''
+    Deletes the report at `report_key` (if there is one) and takes it out of its YearTotals, then
+    updates the later reports of its year and the month rollups like `save_report` does
+    '''
+    @ndb.transactional(xg=True)
+    def txn():
+        old_report = report_key.get()
+        if old_report is None:
+            return (None, None, False)
+        totals = YearTotals.key_for_year(old_report.date.year).get()
+        version = None
+        needs_refresh = False
+        if totals is not None:
+            needs_refresh = totals.remove(old_report)
+            totals.version += 1
+            version = totals.version
+            totals.put()
+        report_key.delete()
+        return (old_report, version, needs_refresh)
+
+    old_report, version, needs_refresh = txn()
+    if old_report is None:
+        return
+    if version is not None:
+        YearIndex.apply_write(old_report.date.year, version, old_report=old_report)
+    if needs_refresh:
+        _refresh_last_finalized_date(old_report.date.year, old_report.date)
+    update_year_derived_data_or_retry(old_report.date.year, old_report.get_date())
+
+
+# Reports per `save_reports` transaction: with their YearTotals that's the 25 entity groups a
+# cross-group transaction can span
+SAVE_REPORTS_TRANSACTION_SIZE = 24
+
+
+def save_reports(reports):
+    '''
+    `save_report` for many reports at once, i.e. an import. The reports are put in transactions of up to
+    SAVE_REPORTS_TRANSACTION_SIZE reports of the same year, each of which also takes the reports they
+    replace out of the YearTotals and adds them in. When several reports have the same date, the last
+    one wins. Returns the years that were written to.
+
+    Unlike `save_report` this leaves the stored yearly numbers and rollups alone: call
+    `update_year_derived_data_or_retry` for each year once everything is saved.
+    '''
+    reports_by_key = dict((report.key, report) for report in reports)
+    reports_by_year = {}
+    for report in sorted(reports_by_key.values(), key=lambda report: report.date):
+        reports_by_year.setdefault(report.date.year, []).append(report)
+    for year, year_reports in sorted(reports_by_year.items()):
+        # Make sure the totals exist before the transactions, building them needs a (non-ancestor) query
+        YearTotals.get_for_year(year)
+        for i in range(0, len(year_reports), SAVE_REPORTS_TRANSACTION_SIZE):
+            _save_year_reports(year, year_reports[i:i + SAVE_REPORTS_TRANSACTION_SIZE])
+    return sorted(reports_by_year)
+
+
+def _save_year_reports(year, reports):
+    @ndb.transactional(xg=True)
+    def txn():
+        key = YearTotals.key_for_year(year)
+        totals = key.get() or YearTotals(key=key)
+        old_reports = ndb.get_multi([report.key for report in reports])
+        refresh_dates = []
+        for old_report, report in zip(old_reports, reports):
+            if old_report is not None and totals.remove(old_report) and not report.is_finalized():
+                refresh_dates.append(report.date)
+            totals.add(report)
+        start_version = totals.version
+        # One version per report, so the cached index can be patched a report at a time like after save_report
+        totals.version += len(reports)
+        ndb.put_multi(reports + [totals])
+        return (old_reports, start_version, refresh_dates)
+
+    old_reports, start_version, refresh_dates = txn()
+    for i, (old_report, report) in enumerate(zip(old_reports, reports), 1):
+        YearIndex.apply_write(year, start_version + i, old_report=old_report, new_report=report)
+    for date in refresh_dates:
+        _refresh_last_finalized_date(year, date)
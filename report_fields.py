@@ -0,0 +1,184 @@
+'''
+The Report fields that the create report form, the report pages and `Report.update` deal with, declared
+once in REPORT_FIELDS.
+
+At import time the schema is turned into three straight-line functions (the same way
+collections.namedtuple builds its classes), so converting a report doesn't loop over the fields or
+branch on their types:
+
+* `populate_from_form(report, request)` sets the form fields from a request (or any dict-like
+  with `get`), turning '' into None and parsing numbers, times and dates like the form expects.
+* `to_display_dict(report)` is the dict the templates show, with None shown as ''. Getters like
+  `get_end_time` are called once each.
+* `merge_fields(report, other)` copies the fields `other` has values for onto `report`.
+'''
+import datetime
+import re
+
+
+class Field(object):
+    '''
+    One Report field.
+        kind: 'int', 'string', 'time' or 'date', i.e. how it's parsed from the form and displayed
+        in_form: whether the create report form has an input for it
+        display_getter: Report method whose result is displayed instead of the field itself
+        display: False to leave it out of `to_display_dict`
+        blank_if_falsy: display 0 as '' too, not just None
+    '''
+    __slots__ = ('name', 'kind', 'in_form', 'display_getter', 'display', 'blank_if_falsy')
+
+    def __init__(self, name, kind, in_form=True, display_getter=None, display=True, blank_if_falsy=False):
+        self.name = name
+        self.kind = kind
+        self.in_form = in_form
+        self.display_getter = display_getter
+        self.display = display
+        self.blank_if_falsy = blank_if_falsy
+
+
+REPORT_FIELDS = [
+    # Goals snapshot, taken from the Goals rather than the form
+    Field('yearly_dream_goal', 'int', in_form=False, blank_if_falsy=True),
+    Field('year_goal', 'string', in_form=False),
+    Field('month_goal', 'string', in_form=False),
+    # Displayed from the yearly numbers instead, see create_report_dict_from_report_obj
+    Field('daily_dream_goal', 'int', in_form=False, display=False),
+
+    Field('date', 'date'),
+    Field('lunch_customers_today', 'int'),
+    Field('customers_today', 'int', display_getter='get_customers_today'),
+    Field('dinner_customers_today', 'int', in_form=False),
+    Field('lunch_dreams', 'int'),
+    Field('dreams', 'int', display_getter='get_dreams'),
+    Field('dinner_dreams', 'int', in_form=False),
+    Field('lunch_dreamers', 'int'),
+    Field('dreamers', 'int', display_getter='get_dreamers'),
+    Field('dinner_dreamers', 'int', in_form=False),
+
+    Field('working_dishwasher', 'string'),
+    Field('working_host', 'string'),
+    Field('working_kitchen2', 'string'),
+    Field('working_kitchen', 'string'),
+    Field('working_members', 'string', in_form=False),
+    Field('supporting_members', 'string'),
+    Field('visiting_members', 'string'),
+
+    Field('end_time_dishwasher', 'time'),
+    Field('end_time_host', 'time'),
+    Field('end_time_kitchen', 'time'),
+    Field('end_time', 'time', in_form=False, display_getter='get_end_time'),
+
+    Field('total_bowls', 'int'),
+    Field('total_cups', 'int'),
+    Field('chopsticks_missing', 'int'),
+    Field('money_off_by', 'int'),
+    Field('positive_cycle', 'int'),
+    Field('misc_notes', 'string'),
+]
+
+
+def parse_int(value):
+    ''' '' or None -> None, otherwise the number (a leading "$" is allowed) '''
+    if value is None or value == '':
+        return None
+    return int(value.replace('$', ''))
+
+
+# What the form sends, parsed without strptime (which is most of the cost of parsing a report).
+# Anything else still goes through strptime, so the same values are accepted and rejected.
+_TIME_RE = re.compile(r'^([0-9][0-9]?):([0-9][0-9])\Z')
+_DATE_RE = re.compile(r'^([0-9]{4})-([0-9]{2})-([0-9]{2})\Z')
+
+
+def parse_time(value):
+    ''' "23:15" or "2315" -> datetime.time, '' -> None '''
+    if not value:
+        return None
+    match = _TIME_RE.match(value)
+    if match is not None:
+        return datetime.time(int(match.group(1)), int(match.group(2)))
+    if ':' in value:
+        return datetime.datetime.strptime(value, '%H:%M').time()
+    return datetime.datetime.strptime(value, '%H%M').time()
+
+
+def parse_date(value):
+    ''' "2018-06-13" -> datetime.datetime, '' -> None '''
+    if not value:
+        return None
+    match = _DATE_RE.match(value)
+    if match is not None:
+        return datetime.datetime(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+# How each kind is read from the form, shown on the page, and what counts as "has a value" for merging
+_PARSE_SOURCE = {
+    'int': "parse_int(get({name!r}, None))",
+    'string': "get({name!r}, '')",
+    'time': "parse_time(get({name!r}, ''))",
+    'date': "parse_date(get({name!r}, ''))",
+}
+_DISPLAY_SOURCE = {
+    'int': "'' if {var} is None else {var}",
+    'string': "'' if {var} is None else {var}",
+    'time': "'' if {var} is None else {var}.strftime('%H:%M')",
+    'date': "'' if {var} is None else {var}.strftime('%Y-%m-%d')",
+}
+# Strings can be '', which doesn't count as a value either
+_HAS_VALUE_SOURCE = {
+    'int': "{var} is not None",
+    'string': "{var}",
+    'time': "{var} is not None",
+    'date': "{var} is not None",
+}
+
+
+def _make_populate_source(fields):
+    lines = ['def populate_from_form(report, request):', '    get = request.get']
+    for field in fields:
+        if field.in_form:
+            lines.append('    report.{} = {}'.format(field.name, _PARSE_SOURCE[field.kind].format(name=field.name)))
+    return '\n'.join(lines) + '\n'
+
+
+def _make_display_source(fields):
+    lines = ['def to_display_dict(report):']
+    entries = []
+    for i, field in enumerate(field for field in fields if field.display):
+        var = 'v{}'.format(i)
+        if field.display_getter is not None:
+            lines.append('    {} = report.{}()'.format(var, field.display_getter))
+        else:
+            lines.append('    {} = report.{}'.format(var, field.name))
+        if field.blank_if_falsy:
+            value_source = "{var} or ''".format(var=var)
+        else:
+            value_source = _DISPLAY_SOURCE[field.kind].format(var=var)
+        entries.append('        {!r}: {},'.format(field.name, value_source))
+    lines.append('    return {')
+    lines.extend(entries)
+    lines.append('    }')
+    return '\n'.join(lines) + '\n'
+
+
+def _make_merge_source(fields):
+    lines = ['def merge_fields(report, other):']
+    for field in fields:
+        lines.append('    value = other.{}'.format(field.name))
+        lines.append('    if {}:'.format(_HAS_VALUE_SOURCE[field.kind].format(var='value')))
+        lines.append('        report.{} = value'.format(field.name))
+    return '\n'.join(lines) + '\n'
+
+
+def _compile(name, source):
+    namespace = {'parse_int': parse_int, 'parse_time': parse_time, 'parse_date': parse_date}
+    exec(compile(source, '<report_fields.{}>'.format(name), 'exec'), namespace)
+    function = namespace[name]
+    function.source = source
+    return function
+
+
+populate_from_form = _compile('populate_from_form', _make_populate_source(REPORT_FIELDS))
+to_display_dict = _compile('to_display_dict', _make_display_source(REPORT_FIELDS))
+merge_fields = _compile('merge_fields', _make_merge_source(REPORT_FIELDS))
@@ -0,0 +1,94 @@
+'''
+Monthly rollups: the /stats numbers of each month, precomputed and saved as one small entity per month.
+
+Each rollup records the YearTotals version it was computed for. After a write, the year's rollups are
+recomputed from its (cached) YearIndex and saved with the new version by `report.update_year_derived_data`,
+which keeps retrying until that goes through; /rebuildtotals recomputes them from scratch. Reads only
+ever get the 12 rollup entities and never write, so the stats pages cost the same however many reports
+there are, and looking at a year without any reports doesn't create anything.
+'''
+import logging
+
+from google.appengine.ext import ndb
+
+import stats
+from report import YearIndex, YearTotals
+
+
+class MonthRollup(ndb.Model):
+    '''
+    Sums over the finalized reports of one month, keyed by "2018-06".
+    The fields are stats.MONTHLY_TOTAL_FIELDS, plus the sum of the reports' achievement rates.
+    '''
+    year = ndb.IntegerProperty()
+    month = ndb.IntegerProperty()
+    total_lunch_dreams = ndb.IntegerProperty(default=0)
+    total_dinner_dreams = ndb.IntegerProperty(default=0)
+    total_lunch_dreamers = ndb.IntegerProperty(default=0)
+    total_dinner_dreamers = ndb.IntegerProperty(default=0)
+    total_lunch_customers = ndb.IntegerProperty(default=0)
+    total_dinner_customers = ndb.IntegerProperty(default=0)
+    lunch_denom = ndb.IntegerProperty(default=0)
+    dinner_denom = ndb.IntegerProperty(default=0)
+    denom = ndb.IntegerProperty(default=0)
+    achievement_rate_sum = ndb.FloatProperty(default=0.)
+    # YearTotals.version of the year when this was computed
+    totals_version = ndb.IntegerProperty(default=0)
+
+    @staticmethod
+    def key_for_month(year, month, namespace=None):
+        ''' In the current namespace (location) unless `namespace` is given '''
+        return ndb.Key(MonthRollup, '{}-{:02d}'.format(year, month), namespace=namespace)
+
+    @staticmethod
+    def from_totals(year, month, month_totals, totals_version):
+        return MonthRollup(key=MonthRollup.key_for_month(year, month), year=year, month=month,
+                           totals_version=totals_version, **month_totals)
+
+    def to_dict(self):
+        d = {field: getattr(self, field) for field in stats.MONTHLY_TOTAL_FIELDS}
+        d['achievement_rate_sum'] = self.achievement_rate_sum
+        return d
+
+
+def build_rollups(year, index):
+    ''' The 12 rollups of `year`, computed from its YearIndex and tagged with the version the index is for '''
+    monthly_totals = stats.get_monthly_totals(index.rows, 12)
+    return [MonthRollup.from_totals(year, month, monthly_totals[month - 1], index.version) for month in range(1, 13)]
+
+
+@ndb.tasklet
+def update_rollups_async(year):
+    '''
+    Recomputes and saves the 12 rollups of `year`. Returns False without saving anything if the reports
+    query doesn't agree with the YearTotals yet.
+    '''
+    totals = yield YearTotals.get_for_year_async(year)
+    index = yield YearIndex.get_for_year_async(year, totals)
+    if not index.matches(totals):
+        logging.warning('Not saving the %d rollups yet, the reports query disagrees with the totals', year)
+        raise ndb.Return(False)
+    yield ndb.put_multi_async(build_rollups(year, index))
+    raise ndb.Return(True)
+
+
+def update_rollups(year):
+    return update_rollups_async(year).get_result()
+
+
+@ndb.tasklet
+def get_rollups_for_year_async(year):
+    '''
+    The 12 saved rollups of `year`, as they are. Months that don't have one (i.e. in a year without
+    reports) come back empty, and aren't saved.
+    '''
+    keys = [MonthRollup.key_for_month(year, month) for month in range(1, 13)]
+    rollups = yield ndb.get_multi_async(keys)
+    raise ndb.Return([rollup if rollup is not None else MonthRollup(key=key, year=year, month=month)
+                      for month, key, rollup in zip(range(1, 13), keys, rollups)])
+
+
+def get_rollups_for_years(years):
+    ''' {year: its 12 rollups} for every year in `years`, fetched concurrently '''
+    futures = [get_rollups_for_year_async(year) for year in years]
+    return dict(zip(years, [future.get_result() for future in futures]))
@@ -0,0 +1,249 @@
+'''
+Column-oriented versions of the per-report math in report.py, for pages that aggregate a lot of reports.
+
+The reports are unpacked into NumPy arrays once, then everything is computed with whole-array
+operations instead of calling the Report getters report by report.
+'''
+import datetime
+import numpy
+
+
+MONTH_STRINGS = [datetime.date(2018, month, 1).strftime('%B') for month in range(1, 13)]
+
+
+class ReportColumns(object):
+    '''
+    The fields of a list of finalized reports as parallel arrays, sorted by date.
+    '''
+    def __init__(self, reports):
+        reports = sorted((report for report in reports if report.is_finalized()), key=lambda x: x.date)
+        self.num_reports = len(reports)
+        self.dates = [report.date.date() for report in reports]
+        self.months = numpy.array([date.month - 1 for date in self.dates], dtype=int)
+        self.ordinals = numpy.array([date.toordinal() for date in self.dates], dtype=int)
+        self.year_end_ordinals = numpy.array([datetime.date(date.year, 12, 31).toordinal() for date in self.dates], dtype=int)
+
+        self.lunch_dreams = numpy.array([report.lunch_dreams for report in reports], dtype=int)
+        self.dinner_dreams = numpy.array([report.dinner_dreams for report in reports], dtype=int)
+        self.lunch_dreamers = numpy.array([report.lunch_dreamers for report in reports], dtype=int)
+        self.dinner_dreamers = numpy.array([report.dinner_dreamers for report in reports], dtype=int)
+        self.lunch_customers = numpy.array([report.lunch_customers_today for report in reports], dtype=int)
+        self.dinner_customers = numpy.array([report.dinner_customers_today for report in reports], dtype=int)
+        # `dreams` is the total entered on the form, which is what the achievement rate has always used
+        self.dreams = numpy.array([report.dreams if report.dreams is not None else report.get_dreams()
+                                   for report in reports], dtype=int)
+        self.yearly_dream_goals = numpy.array([report.yearly_dream_goal or 0 for report in reports], dtype=int)
+
+    def get_working_days_left_in_year(self):
+        ''' Same as main.get_working_days_left_in_year, for every report at once '''
+        days_until_year_end = self.year_end_ordinals - self.ordinals
+        working_days_until_year_end = (5. / 7. * days_until_year_end).astype(int) - 4
+        return numpy.maximum(1, working_days_until_year_end)
+
+    def get_daily_dream_goals(self):
+        '''
+        Each report's daily dream goal: the dreams still missing from its yearly goal as of that day
+        (a running sum over the year, so this assumes the reports all come from one year), spread over
+        the working days left.
+        '''
+        dreams_this_year = numpy.cumsum(self.lunch_dreams + self.dinner_dreams)
+        dreams_remaining = numpy.maximum(0, self.yearly_dream_goals - dreams_this_year)
+        return (dreams_remaining / self.get_working_days_left_in_year().astype(float)).astype(int)
+
+    def get_achievement_rates(self):
+        daily_dream_goals = self.get_daily_dream_goals()
+        safe_goals = numpy.where(daily_dream_goals == 0, 1, daily_dream_goals)
+        return numpy.where(daily_dream_goals == 0, 100., self.dreams / safe_goals.astype(float) * 100)
+
+
+def _format_average(totals, denoms):
+    return ['{:.2f}'.format(total / float(max(1, denom))) for total, denom in zip(totals, denoms)]
+
+
+MONTHLY_TOTAL_FIELDS = [
+    'total_lunch_dreams',
+    'total_dinner_dreams',
+    'total_lunch_dreamers',
+    'total_dinner_dreamers',
+    'total_lunch_customers',
+    'total_dinner_customers',
+    'lunch_denom',
+    'dinner_denom',
+    'denom',
+]
+
+
+def get_monthly_totals(reports, num_months=12):
+    '''
+    Per-month sums over `reports` (one year's reports) for the first `num_months` months of the year:
+    a dict of MONTHLY_TOTAL_FIELDS -> int, plus the float 'achievement_rate_sum', for each month.
+    Everything is one pass to build the columns plus a bincount per number.
+    '''
+    columns = ReportColumns(reports)
+    in_range = columns.months < num_months
+    months = columns.months[in_range]
+
+    def month_sums(values):
+        if len(months) == 0:
+            return numpy.zeros(num_months)
+        return numpy.bincount(months, weights=values[in_range], minlength=num_months)[:num_months]
+
+    lunch_open = (columns.lunch_dreams != 0) | (columns.lunch_dreamers != 0) | (columns.lunch_customers != 0)
+    dinner_open = (columns.dinner_dreams != 0) | (columns.dinner_dreamers != 0) | (columns.dinner_customers != 0)
+
+    totals = {
+        'total_lunch_dreams': month_sums(columns.lunch_dreams),
+        'total_dinner_dreams': month_sums(columns.dinner_dreams),
+        'total_lunch_dreamers': month_sums(columns.lunch_dreamers),
+        'total_dinner_dreamers': month_sums(columns.dinner_dreamers),
+        'total_lunch_customers': month_sums(columns.lunch_customers),
+        'total_dinner_customers': month_sums(columns.dinner_customers),
+        'lunch_denom': month_sums(lunch_open.astype(int)),
+        'dinner_denom': month_sums(dinner_open.astype(int)),
+        'denom': month_sums(numpy.ones(columns.num_reports, dtype=int)),
+    }
+    achievement_rate_sums = month_sums(columns.get_achievement_rates())
+
+    monthly_totals = [{key: int(values[i]) for key, values in totals.items()} for i in range(num_months)]
+    for i, month_totals in enumerate(monthly_totals):
+        month_totals['achievement_rate_sum'] = float(achievement_rate_sums[i])
+    return monthly_totals
+
+
+def _format_stats(totals):
+    ''' Adds the averages shown on /stats to a copy of a `get_monthly_totals`-style dict '''
+    stats_dict = dict(totals)
+    for key in ['dreams', 'dreamers', 'customers']:
+        for meal in ['lunch', 'dinner']:
+            average = _format_average([totals['total_{}_{}'.format(meal, key)]], [totals['{}_denom'.format(meal)]])[0]
+            stats_dict['average_{}_{}'.format(meal, key)] = average
+    if totals['denom'] > 0:
+        stats_dict['average_dream_achievement_rate'] = '{:.2f}'.format(totals['achievement_rate_sum'] / totals['denom'])
+    else:
+        stats_dict['average_dream_achievement_rate'] = 0.0
+    stats_dict['num_reports'] = totals['denom']
+    return stats_dict
+
+
+def format_monthly_stats(monthly_totals):
+    '''
+    The per-month dicts shown on /stats, from `get_monthly_totals`-style dicts starting at January
+    (i.e. MonthRollup.to_dict()s)
+    '''
+    monthly_stats_list = [_format_stats(month_totals) for month_totals in monthly_totals]
+    for i, month_dict in enumerate(monthly_stats_list):
+        month_dict['month_string'] = MONTH_STRINGS[i]
+    return monthly_stats_list
+
+
+def format_year_stats(monthly_totals):
+    ''' Same as `format_monthly_stats`, but for all the months of `monthly_totals` together '''
+    year_totals = dict((key, sum(month_totals[key] for month_totals in monthly_totals))
+                       for key in MONTHLY_TOTAL_FIELDS + ['achievement_rate_sum'])
+    return _format_stats(year_totals)
+
+
+OPEN_WEEKDAYS = ['Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday']
+# date.weekday() of OPEN_WEEKDAYS[0]
+FIRST_OPEN_WEEKDAY = 1
+
+
+def make_weekly_customer_tables(reports, year):
+    '''
+    Customer counts of `year` as a week x open weekday grid, for lunch and for dinner:
+        {'lunch': [(date of the week's Tuesday, [Tuesday count, ..., Saturday count], week total), ...], 'dinner': ...}
+    newest week first. Weeks run Monday to Sunday like ISO weeks, numbered from the one containing
+    January 1st, through the week of the last report. Days without a report are 0.
+    '''
+    columns = ReportColumns(reports)
+    first_monday = datetime.date(year, 1, 1).toordinal()
+    first_monday -= (first_monday - 1) % 7  # ordinal 1 (Jan 1st, year 1) was a Monday
+    weeks = (columns.ordinals - first_monday) // 7
+    days = (columns.ordinals - first_monday) % 7 - FIRST_OPEN_WEEKDAY
+    is_open_day = (days >= 0) & (days < len(OPEN_WEEKDAYS)) & (weeks >= 0)
+    num_weeks = int(weeks[is_open_day].max()) + 1 if is_open_day.any() else 0
+    cells = weeks[is_open_day] * len(OPEN_WEEKDAYS) + days[is_open_day]
+
+    def grid(values):
+        if num_weeks == 0:
+            return numpy.zeros((0, len(OPEN_WEEKDAYS)), dtype=int)
+        counts = numpy.bincount(cells, weights=values[is_open_day], minlength=num_weeks * len(OPEN_WEEKDAYS))
+        return counts.astype(int).reshape((num_weeks, len(OPEN_WEEKDAYS)))
+
+    week_starts = [datetime.date.fromordinal(first_monday + 7 * week + FIRST_OPEN_WEEKDAY) for week in range(num_weeks)]
+    tables = {}
+    for meal, values in [('lunch', columns.lunch_customers), ('dinner', columns.dinner_customers)]:
+        matrix = grid(values)
+        week_totals = matrix.sum(axis=1)
+        tables[meal] = [(week_starts[week], matrix[week].tolist(), int(week_totals[week]))
+                        for week in reversed(range(num_weeks))]
+    return tables
+
+
+def get_weekly_customer_tables(index):
+    ''' `make_weekly_customer_tables` for a YearIndex, computed once per version of the index '''
+    tables = index.derived.get('weekly_customer_tables')
+    if tables is None:
+        tables = make_weekly_customer_tables(index.rows, index.year)
+        index.derived['weekly_customer_tables'] = tables
+    return tables
+
+
+# The per-day goals of a dream calculator scenario
+DREAM_GOAL_KEYS = [
+    'lunch_customers_today',
+    'lunch_dreams',
+    'lunch_dreamers',
+    'dinner_customers_today',
+    'dinner_dreams',
+    'dinner_dreamers',
+]
+
+# How DREAM_GOAL_KEYS read on the dream calculator
+DREAM_GOAL_LABELS = {
+    'lunch_customers_today': 'Lunch customers',
+    'lunch_dreams': 'Lunch dreams',
+    'lunch_dreamers': 'Lunch dreamers',
+    'dinner_customers_today': 'Dinner customers',
+    'dinner_dreams': 'Dinner dreams',
+    'dinner_dreamers': 'Dinner dreamers',
+}
+
+
+def evaluate_dream_scenarios(month_reports, scenarios):
+    '''
+    Compares a month's reports against every per-day goal dict in `scenarios` (DREAM_GOAL_KEYS -> int).
+    A meal only counts on days when its customers, dreamers and dreams are all above 0.
+    Returns (actual, [{'goals': ..., 'expected': ..., 'percent': ...} for each scenario]), all dicts
+    keyed by DREAM_GOAL_KEYS: `actual` is the month's totals, `expected` is the goal times the number
+    of days the meal counted, and `percent` is actual / expected (100 when nothing was expected).
+    '''
+    columns = ReportColumns(month_reports)
+    lunch_counted = (columns.lunch_customers > 0) & (columns.lunch_dreamers > 0) & (columns.lunch_dreams > 0)
+    dinner_counted = (columns.dinner_customers > 0) & (columns.dinner_dreamers > 0) & (columns.dinner_dreams > 0)
+    actual = numpy.array([
+        columns.lunch_customers[lunch_counted].sum(),
+        columns.lunch_dreams[lunch_counted].sum(),
+        columns.lunch_dreamers[lunch_counted].sum(),
+        columns.dinner_customers[dinner_counted].sum(),
+        columns.dinner_dreams[dinner_counted].sum(),
+        columns.dinner_dreamers[dinner_counted].sum(),
+    ], dtype=int)
+    num_days = numpy.array([lunch_counted.sum()] * 3 + [dinner_counted.sum()] * 3, dtype=int)
+
+    # One row per scenario, one column per goal
+    goals = numpy.array([[scenario[key] for key in DREAM_GOAL_KEYS] for scenario in scenarios], dtype=int)
+    goals = goals.reshape((len(scenarios), len(DREAM_GOAL_KEYS)))
+    expected = goals * num_days
+    safe_expected = numpy.where(expected == 0, 1, expected)
+    percents = numpy.where(expected == 0, 100., actual / safe_expected.astype(float) * 100)
+
+    actual_dict = dict(zip(DREAM_GOAL_KEYS, actual.tolist()))
+    results = []
+    for i in range(len(scenarios)):
+        results.append({
+            'goals': dict(zip(DREAM_GOAL_KEYS, goals[i].tolist())),
+            'expected': dict(zip(DREAM_GOAL_KEYS, expected[i].tolist())),
+            'percent': dict(zip(DREAM_GOAL_KEYS, percents[i].tolist())),
+        })
+    return (actual_dict, results)
@@ -0,0 +1,111 @@
+'''
+Builds static/ for deploying: a copy of every asset named after its content hash, larger versions of
+the logo for high-density screens (needs PIL/Pillow, skipped without it) and static/manifest.json,
+which assets.py reads to put the hashed URLs into the templates.
+
+Run it before every deploy, otherwise the pages keep pointing at the assets as they were last built:
+    python tools/build_assets.py
+'''
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATIC_DIR = os.path.join(REPO_ROOT, 'static')
+
+ASSETS = ['style.css', 'jquery-3.2.1.min.js']
+ASSET_DIRS = ['images']
+# Image as used in the templates -> (larger source image, [(width in pixels, srcset descriptor)]).
+# The image itself is the 1x version.
+RESPONSIVE_IMAGES = {
+    'images/logo.jpg': ('images/logo fullsize.png', [(840, '2x'), (1260, '3x')]),
+}
+JPEG_QUALITY = 85
+
+
+def get_asset_paths():
+    paths = list(ASSETS)
+    for asset_dir in ASSET_DIRS:
+        for name in sorted(os.listdir(os.path.join(REPO_ROOT, asset_dir))):
+            if not name.startswith('.'):
+                paths.append(asset_dir + '/' + name)
+    return paths
+
+
+def get_hashed_path(path, data):
+    ''' "images/logo.jpg" -> "images/logo.<hash>.jpg", with spaces replaced so the URL doesn't need quoting '''
+    root, ext = os.path.splitext(path.replace(' ', '-'))
+    return '{}.{}{}'.format(root, hashlib.sha1(data).hexdigest()[:12], ext)
+
+
+def write_asset(path, data):
+    ''' Writes `data` to static/ under its hashed name, and returns that name '''
+    hashed_path = get_hashed_path(path, data)
+    output_path = os.path.join(STATIC_DIR, hashed_path)
+    if not os.path.isdir(os.path.dirname(output_path)):
+        os.makedirs(os.path.dirname(output_path))
+    with open(output_path, 'wb') as f:
+        f.write(data)
+    return hashed_path
+
+
+def resize_to_jpeg(source_path, width):
+    ''' The image at `source_path` scaled down to `width` pixels wide, as JPEG data, or None if it isn't that wide '''
+    image = Image.open(os.path.join(REPO_ROOT, source_path))
+    if width > image.size[0]:
+        return None
+    height = int(round(image.size[1] * float(width) / image.size[0]))
+    resized = image.convert('RGB').resize((width, height), Image.LANCZOS)
+    output = io.BytesIO()
+    resized.save(output, 'JPEG', quality=JPEG_QUALITY, optimize=True, progressive=True)
+    return output.getvalue()
+
+
+def build():
+    ''' Rebuilds static/ from scratch and returns the manifest '''
+    if os.path.isdir(STATIC_DIR):
+        shutil.rmtree(STATIC_DIR)
+    os.makedirs(STATIC_DIR)
+    # assets.py checks the hashes of the source files, so it doesn't serve entries for files edited since
+    manifest = {'assets': {}, 'srcsets': {}, 'srcset_sources': {}, 'source_hashes': {}}
+    for path in get_asset_paths():
+        with open(os.path.join(REPO_ROOT, path), 'rb') as f:
+            data = f.read()
+        manifest['assets'][path] = write_asset(path, data)
+        manifest['source_hashes'][path] = hashlib.sha1(data).hexdigest()
+        print('{} -> {} ({} bytes)'.format(path, manifest['assets'][path], len(data)))
+    if Image is None:
+        print('PIL is not installed, not building the responsive images')
+    else:
+        for path, (source_path, sizes) in sorted(RESPONSIVE_IMAGES.items()):
+            srcset = [(manifest['assets'][path], '1x')]
+            for width, descriptor in sizes:
+                data = resize_to_jpeg(source_path, width)
+                if data is None:
+                    print('{} is narrower than {}px, skipping {} {}'.format(source_path, width, path, descriptor))
+                    continue
+                srcset.append((write_asset('{}-{}w.jpg'.format(os.path.splitext(path)[0], width), data), descriptor))
+                print('{} {} -> {} ({} bytes)'.format(path, descriptor, srcset[-1][0], len(data)))
+            manifest['srcsets'][path] = srcset
+            manifest['srcset_sources'][path] = source_path
+    with open(os.path.join(STATIC_DIR, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def run_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+    build()
+
+
+if __name__ == '__main__':
+    run_from_command_line()
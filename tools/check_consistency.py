@@ -0,0 +1,58 @@
+'''
+Runs the consistency checker (consistency.py) against a local datastore, i.e. the one dev_appserver.py
+keeps in --datastore_path, and prints the summary.
+
+Usage (needs the App Engine Python SDK, i.e. the directory containing dev_appserver.py):
+    python tools/check_consistency.py --sdk ~/google-cloud-sdk/platform/google_appengine \
+        --app-id dev~yumenightreport --datastore-path /tmp/datastore.db [--repair]
+'''
+import argparse
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_sdk_path(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+
+
+def run(app_id, datastore_path, repair=False, batch_size=None):
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=app_id, overwrite=True)
+    bed.init_datastore_v3_stub(datastore_file=datastore_path, use_sqlite=True, save_changes=repair)
+    bed.init_memcache_stub()
+    # A repair can hand a year's derived data update to a task
+    bed.init_taskqueue_stub()
+    try:
+        import bulk
+        import consistency
+        summary = consistency.check(repair=repair, batch_size=batch_size or bulk.EXPORT_BATCH_SIZE)
+        sys.stdout.write(summary.as_text())
+        return summary
+    finally:
+        bed.deactivate()
+
+
+def run_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'), help='Path to the App Engine Python SDK')
+    parser.add_argument('--app-id', required=True, help='Application id the local datastore was written with')
+    parser.add_argument('--datastore-path', required=True, help='The dev_appserver.py datastore file')
+    parser.add_argument('--repair', action='store_true', help='Also fix the discrepancies')
+    parser.add_argument('--batch-size', type=int, help='Reports fetched per datastore call')
+    args = parser.parse_args()
+    setup_sdk_path(args.sdk)
+    summary = run(args.app_id, args.datastore_path, args.repair, args.batch_size)
+    if summary.discrepancies and not args.repair:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    run_from_command_line()
@@ -0,0 +1,53 @@
+'''
+Precompiles every template into Python modules in compiled_templates/, which main.py then loads
+with a jinja2.ModuleLoader instead of parsing the templates on each new instance. The hash of each
+template's source goes into compiled_templates/sources.json, so a template edited after compiling
+is read from its source rather than served as it was compiled.
+
+Run it before every deploy, otherwise edited templates lose the benefit of being precompiled:
+    python tools/compile_templates.py --sdk ~/google-cloud-sdk/platform/google_appengine
+'''
+import argparse
+import json
+import os
+import shutil
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_sdk_path(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+
+
+def compile_templates():
+    ''' Returns the names of the templates that were compiled '''
+    import jinja2
+    import main
+    # Same settings as the app's environment, but always reading the template sources
+    environment = main.make_jinja_environment(jinja2.FileSystemLoader(main.TEMPLATES_DIR))
+    names = main.get_template_names()
+    if os.path.isdir(main.COMPILED_TEMPLATES_DIR):
+        shutil.rmtree(main.COMPILED_TEMPLATES_DIR)
+    environment.compile_templates(main.COMPILED_TEMPLATES_DIR, filter_func=lambda name: name in names,
+                                  zip=None, ignore_errors=False, py_compile=False)
+    with open(main.COMPILED_TEMPLATES_SOURCES_PATH, 'w') as f:
+        json.dump(dict((name, main.get_template_source_hash(name)) for name in names), f, indent=2, sort_keys=True)
+    return names
+
+
+def run_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'), help='Path to the App Engine Python SDK')
+    args = parser.parse_args()
+    setup_sdk_path(args.sdk)
+    names = compile_templates()
+    print('Compiled {} templates: {}'.format(len(names), ', '.join(names)))
+
+
+if __name__ == '__main__':
+    run_from_command_line()
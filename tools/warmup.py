@@ -0,0 +1,54 @@
+'''
+Runs the same priming as the /_ah/warmup request (warmup.py) in a fresh process against a local
+datastore, i.e. the one dev_appserver.py keeps in --datastore_path, and prints how long each stage took.
+
+Usage (needs the App Engine Python SDK, i.e. the directory containing dev_appserver.py):
+    python tools/warmup.py --sdk ~/google-cloud-sdk/platform/google_appengine \
+        --app-id dev~yumenightreport --datastore-path /tmp/datastore.db [--year 2018]
+'''
+import argparse
+import logging
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def setup_sdk_path(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, REPO_ROOT)
+
+
+def run(app_id, datastore_path, year=None):
+    from google.appengine.ext import testbed
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id=app_id, overwrite=True)
+    bed.init_datastore_v3_stub(datastore_file=datastore_path, use_sqlite=True, save_changes=False)
+    bed.init_memcache_stub()
+    try:
+        import warmup
+        timings = warmup.prime_caches(year)
+        sys.stdout.write(warmup.format_timings(timings))
+        return timings
+    finally:
+        bed.deactivate()
+
+
+def run_from_command_line():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'), help='Path to the App Engine Python SDK')
+    parser.add_argument('--app-id', required=True, help='Application id the local datastore was written with')
+    parser.add_argument('--datastore-path', required=True, help='The dev_appserver.py datastore file')
+    parser.add_argument('--year', type=int, help='Year to preload (defaults to this year)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    setup_sdk_path(args.sdk)
+    run(args.app_id, args.datastore_path, args.year)
+
+
+if __name__ == '__main__':
+    run_from_command_line()
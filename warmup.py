@@ -0,0 +1,78 @@
+'''
+Primes a new instance before it takes traffic: imports every module, compiles every template and loads
+the current year's YearIndex, month rollups and the goals into the instance caches, so the first
+person to open a page after the app has been idle doesn't pay for all of that.
+
+Runs from App Engine's warmup request (/_ah/warmup), or locally with tools/warmup.py.
+'''
+import datetime
+import importlib
+import logging
+import time
+
+
+# main first, so that when this runs in a fresh process the imports stage covers the whole app
+MODULES = ['main', 'report', 'page_cache', 'perf', 'stats', 'rollups', 'bulk', 'consistency']
+
+
+def _import_modules(year):
+    for name in MODULES:
+        importlib.import_module(name)
+
+
+def _compile_templates(year):
+    import main
+    # Cached by the environment, so later `get_template` calls are a dict lookup
+    for name in main.get_template_names():
+        main.JINJA_ENVIRONMENT.get_template(name)
+
+
+def _load_goals(year):
+    import main
+    main.get_goals()
+
+
+def _load_year_index(year):
+    import stats
+    from report import YearIndex, YearTotals
+    index = YearIndex.get_for_year(year, YearTotals.get_for_year(year))
+    stats.get_weekly_customer_tables(index)
+
+
+def _load_rollups(year):
+    import rollups
+    rollups.get_rollups_for_years([year])
+
+
+# In order: the later stages use what the earlier ones loaded
+PRIMING_STAGES = [
+    ('imports', _import_modules),
+    ('templates', _compile_templates),
+    ('goals', _load_goals),
+    ('year index', _load_year_index),
+    ('rollups', _load_rollups),
+]
+
+
+def prime_caches(year=None):
+    '''
+    Runs every priming stage for `year` (defaults to this year) and logs how long each took.
+    Returns a list of (stage name, milliseconds).
+    '''
+    if year is None:
+        year = datetime.datetime.now().year
+    timings = []
+    for name, stage in PRIMING_STAGES:
+        start = time.time()
+        stage(year)
+        elapsed_ms = (time.time() - start) * 1000
+        logging.info('Warmup: %s took %.1f ms', name, elapsed_ms)
+        timings.append((name, elapsed_ms))
+    logging.info('Warmup: done in %.1f ms', sum(elapsed_ms for _, elapsed_ms in timings))
+    return timings
+
+
+def format_timings(timings):
+    lines = ['{}: {:.1f} ms'.format(name, elapsed_ms) for name, elapsed_ms in timings]
+    lines.append('total: {:.1f} ms'.format(sum(elapsed_ms for _, elapsed_ms in timings)))
+    return '\n'.join(lines) + '\n'